@@ -13,7 +13,6 @@ if you like.'''
 import logging
 import sys
 import time
-from collections import defaultdict
 from werkzeug import Local, LocalManager
 from werkzeug.exceptions import HTTPException, InternalServerError, NotFound, _ProxyException
 
@@ -33,23 +32,36 @@ local.error_stream = sys.stderr
 # prevent the werkzeug logger from propagating messages because it has its own output scheme
 #logging.getLogger('werkzeug').propagate = False
 
-from modulo.actions import all_of, any_of, opt
+from modulo.actions import AllActions, all_of, any_of, opt
+from modulo.actions.dispatch import RoutingCache, compile_tree
+from modulo.utilities import namespace_dict
 from modulo.wrappers import Request, Response
 
-def run_everything(tree, request):
+def run_everything(tree, request, instrument=None):
     t0 = timer()
-    handler = tree.handle(request, defaultdict(dict)) # This is where the parameter list gets constructed
+    if instrument is not None:
+        # the actions find it here, even in copies of the environment made by transform()
+        request.environ['modulo.instrument'] = instrument
+    handler = tree.handle(request, namespace_dict()) # This is where the parameter list gets constructed
     if handler is None:
         raise NotFound()
-    logging.getLogger('modulo.actions').debug('\n'+str(handler))
+    if __debug__ and logging.getLogger('modulo.actions').isEnabledFor(logging.DEBUG):
+        # str(handler) walks every action that's handling the request
+        logging.getLogger('modulo.actions').debug('\n%s', handler)
     response = Response()
     request.handler = handler
-    handler.generate(response)
+    if instrument is None or isinstance(handler, AllActions):
+        # AllActions times each of its handlers itself
+        handler.generate(response)
+    else:
+        instrument.generate(handler, response)
     t1 = timer()
-    logging.getLogger('modulo.timer').info('processed in ' + str(t1 - t0) + ' seconds')
+    if instrument is not None:
+        instrument.request_finished(request, t1 - t0)
+    logging.getLogger('modulo.timer').info('processed in %s seconds', t1 - t0)
     return response
 
-def WSGIModuloApp(action_tree, error_tree=None, raise_exceptions=False):
+def WSGIModuloApp(action_tree, error_tree=None, raise_exceptions=False, compiled=False, routing_cache_size=None, instrument=None, profiler=None):
     '''A wrapper that creates a WSGI application from a Modulo action.
 
     ``action_tree`` is the action itself. It can be any subclass of
@@ -80,11 +92,47 @@ def WSGIModuloApp(action_tree, error_tree=None, raise_exceptions=False):
 
     .. todo:: There isn't actually any way to pass information about the error that
         occurred to the ``error_tree`` yet.
+
+    If ``compiled`` is true, ``action_tree`` (and ``error_tree``, if given) will be
+    flattened into a :class:`~modulo.actions.dispatch.DispatchPlan` when the
+    application is created, so that each request is dispatched by running through a
+    precomputed list of instructions instead of recursing through the tree. This
+    produces the same results but cuts down the per-request overhead, especially
+    for large trees.
+
+    If ``routing_cache_size`` is given, the ``action_tree`` is compiled and wrapped
+    in a :class:`~modulo.actions.dispatch.RoutingCache` which remembers the route
+    through the tree taken by up to that many distinct requests, so that repeated
+    requests for the same URL can skip straight to the actions that handled it
+    last time.
+
+    If ``instrument`` is given, it should be an instance of
+    :class:`~modulo.instrumentation.Instrument`, and it will be told how long each
+    action spent on each phase of each request handled by the ``action_tree``.
+    For example, passing a :class:`~modulo.instrumentation.TimingAggregator` lets
+    you find out which actions are responsible for slow requests.
+
+    If ``profiler`` is given, it should be a
+    :class:`~modulo.instrumentation.SamplingProfiler`, which will run ``cProfile``
+    on a fraction of the requests handled by the ``action_tree`` and save the
+    results to disk. This works with any of the ways of handling exceptions
+    described above.
     '''
+    if compiled:
+        action_tree = compile_tree(action_tree)
+        if error_tree is not None:
+            error_tree = compile_tree(error_tree)
+    if routing_cache_size:
+        action_tree = RoutingCache(action_tree, routing_cache_size)
+
     @Request.application
     def modulo_application(request):
         '''A basic WSGI wrapper for the ``action_tree``.'''
-        return run_everything(action_tree, request)
+        return run_everything(action_tree, request, instrument)
+
+    if profiler is not None:
+        # all the middleware variants below call modulo_application
+        modulo_application = profiler.wrap(modulo_application)
 
     if raise_exceptions:
         def simple_middleware(environ, start_response):
@@ -17,34 +17,106 @@ either a static file or a CGI script. In contrast, the action architecture
 lets you specify the content and properties of each resource individually,
 and the system takes care of putting them together.'''
 
+import inspect
 import logging
 import os
 import random
 import re
+import threading
 import time
 import urlparse
 import weakref
 from copy import copy
-from modulo.utilities import check_params, hash_iterable, attribute_dict, wrap_dict
+from itertools import count
+from modulo.utilities import check_params, hash_iterable, attribute_dict, namespace_dict, wrap_dict
 from modulo.wrappers import Request
 from os.path import dirname, isfile, join, splitext
 from stat import ST_MTIME
-from werkzeug import validate_arguments
+from types import FunctionType
 from werkzeug import ArgumentValidationError, BaseRequest
 from werkzeug.exceptions import InternalServerError, NotFound
 
 __all__ = ['all_of', 'any_of', 'opt', 'Action']
 
+# Every dynamically created subclass is registered here, so that deriving the
+# same thing twice gives back the same class instead of building a new one.
+# Entries go away when the classes they refer to are garbage collected.
+_derived_classes = weakref.WeakValueDictionary()
+_derived_lock = threading.Lock()
+_derived_serial = count(1)
+
+def _derivation_key(value):
+    '''Returns a hashable stand-in for a value used to derive a class.
+
+    Hashable values stand for themselves (along with their type, so that ``1``
+    and ``True`` aren't confused), tuples are converted element by element, and
+    functions are identified by their code, their globals, and the values they
+    close over, so that the ``lambda`` created by each call to a ``derive()``
+    override (which is a new object every time) doesn't stop identical
+    derivations from being recognized.
+    Anything else, like a list or dict, is identified by the object itself.
+    Derived classes keep references to the values they're made from, so the ID
+    of an object can't be reused while a class derived from it still exists.'''
+    if isinstance(value, tuple):
+        return (tuple, tuple(_derivation_key(v) for v in value))
+    if isinstance(value, (classmethod, staticmethod)):
+        return (type(value), _derivation_key(value.__func__))
+    if isinstance(value, FunctionType):
+        cells = tuple(c.cell_contents for c in value.func_closure or ())
+        if any(c is value for c in cells):
+            return (id, id(value))
+        # code objects compare equal across modules (co_filename isn't compared),
+        # and the same code can look up different globals
+        return (FunctionType, value.func_code, id(value.func_globals), _derivation_key(value.func_defaults), _derivation_key(cells))
+    try:
+        hash(value)
+    except TypeError:
+        return (id, id(value))
+    return (type(value), value)
+
+def _derive_class(base, prefix, key, attributes):
+    '''Returns the subclass of ``base`` registered under ``key``, creating it
+    with the given class ``attributes`` if it doesn't exist yet.
+
+    If ``key`` is ``None``, a new class is always created and it isn't
+    registered. That's for classes which keep mutable state of their own, which
+    mustn't be shared by actions that were created separately.
+
+    The new class is named ``<prefix>_<n>``, where ``<n>`` is a serial number
+    which is also stored in the class as ``derivation_id``.'''
+    if key is not None:
+        key = (base, prefix, key)
+    with _derived_lock:
+        if key is not None:
+            try:
+                return _derived_classes[key]
+            except KeyError:
+                pass
+        attributes['derivation_id'] = serial = next(_derived_serial)
+        # base's metaclass creates the class, so ActionMetaclass.__init__ runs
+        d = type(base)('%s_%d' % (prefix, serial), (base,), attributes)
+        if key is not None:
+            _derived_classes[key] = d
+        return d
+
+def _derived_name(cls):
+    '''Returns the name ``cls`` was derived from and its serial number, or the
+    class name and ``None`` if it wasn't created by ``derive()`` or friends.'''
+    serial = cls.__dict__.get('derivation_id')
+    if serial is None:
+        return cls.__name__, None
+    return cls.__name__[:-len(str(serial)) - 1], serial
+
 def all_of(*cls):
     '''Creates an ``Action`` subclass that passes requests to all given classes.
 
     The returned subclass is a dynamically created subclass of :class:`AllActions`
-    called ``AllActions_<hash value>``, where ``<hash value>`` is a deterministic
-    function of the arguments provided to this function. The subclass delegates calls
+    called ``AllActions_<n>``, where ``<n>`` is a serial number. Calling this function
+    again with the same arguments returns the same class. The subclass delegates calls
     to :meth:`~Action.handles` to its constituent classes (the parameters given in
     ``cls``) such that the ``AllActions`` subclass only accepts the request if *all*
     its constituent classes individually accept the request. When an instance of
-    ``AllActions_<hash value>`` is created in the second phase of processing, it
+    ``AllActions_<n>`` is created in the second phase of processing, it
     internally also creates instances of all its constituent classes to which it
     will delegate calls to instance methods like :meth:`update_mtime` and
     :meth:`generate`.
@@ -63,14 +135,17 @@ def all_of(*cls):
             handler_classes.append(n)
     # Use the metaclass to create a dynamic subclass of AllActions
     # with our list of handler classes.
-    return ActionMetaclass('AllActions_%s' % hash_iterable(handler_classes), (AllActions,), {'handler_classes': handler_classes})
+    return _derive_class(AllActions, 'AllActions', tuple(handler_classes), {'handler_classes': handler_classes})
 
 def any_of(*cls, **kwargs):
     '''Creates an ``Action`` subclass that passes requests to one of the given classes.
 
     The returned subclass is a dynamically created subclass of :class:`AnyAction`
-    called ``AnyAction_<hash value>``, where ``<hash value>`` is a deterministic
-    function of the arguments provided to this function. It delegates calls to
+    called ``AnyAction_<n>``, where ``<n>`` is a serial number. Calling this function
+    again with the same arguments returns the same class, except when ``sortable``
+    is true: then the class counts how many requests each branch accepts and
+    reorders its branches accordingly, and each call gets a class with counts of
+    its own, so that separate trees are sorted independently. It delegates calls to
     :meth:`~Action.handles()` to its constituent classes (the parameters given
     in ``cls``) such that it accepts the request if *any* of the constituent
     classes individually accept the request.
@@ -88,16 +163,23 @@ def any_of(*cls, **kwargs):
         if not issubclass(n, Action):
             return NotImplemented
         if issubclass(n, AnyAction):
-            handler_classes.extend(n.handler_classes)
+            # fresh counters, so this class doesn't count hits for the one it was given
+            handler_classes.extend([0, hc[1]] for hc in n.handler_classes)
         else:
             handler_classes.append([0,n])
-    return type('AnyAction_%s' % hash_iterable(handler_classes), (AnyAction,), {'handler_classes': handler_classes, '_count': 8, '_sortable': kwargs.get('sortable', False)})
+    sortable = kwargs.get('sortable', False)
+    if sortable:
+        # the counts and the order of the branches belong to this class alone
+        key = None
+    else:
+        key = tuple(hc[1] for hc in handler_classes)
+    return _derive_class(AnyAction, 'AnyAction', key, {'handler_classes': handler_classes, '_count': 8, '_sortable': sortable})
 
 def opt(cls):
     '''Creates an Action subclass that wraps a given handler class to make it optional.
 
-    The returned subclass is called OptAction_<hash value>, where <hash value> is a
-    deterministic function of the argument. It returns True from handles(req) for all
+    The returned subclass is called OptAction_<n>, where <n> is a serial number;
+    wrapping the same class again returns the same OptAction. It returns True from handles(req) for all
     requests, but if its constituent class (the parameter given in cls) doesn't actually
     handle the request, attempting to create an instance of OptAction returns a NoopHandler
     (which does nothing) instead. If the constituent class does handle the request, than an
@@ -110,7 +192,63 @@ def opt(cls):
     elif cls.__name__.startswith('OptAction'):
         return cls
     else:
-        return type('OptAction_%s' % hash_iterable([cls]), (OptAction,), {'handler_class': cls})
+        return _derive_class(OptAction, 'OptAction', cls, {'handler_class': cls})
+
+class GenerateSignature(object):
+    '''The argument list of an action's ``generate()`` method.
+
+    This does the same job as Werkzeug's ``validate_arguments()``, but the
+    introspection is done only once per method (signatures are shared between
+    all the classes that inherit the same ``generate()``), and :meth:`bind`
+    only looks up the parameters the method actually asks for. The full
+    parameter set is only copied when ``generate()`` accepts ``**kwargs``.'''
+    _cache = {}
+
+    @classmethod
+    def of(cls, method):
+        func = getattr(method, 'im_func', method)
+        try:
+            return cls._cache[func]
+        except KeyError:
+            sig = cls._cache[func] = cls(func)
+            return sig
+
+    def __init__(self, func):
+        positional, varargs, varkw, defaults = inspect.getargspec(func)
+        defaults = defaults or ()
+        first_default = len(positional) - len(defaults)
+        # the first two arguments, self and the response, are supplied by the caller
+        self.arguments = tuple(
+            (name, i >= first_default, defaults[i - first_default] if i >= first_default else None)
+            for i, name in enumerate(positional) if i >= 2
+        )
+        self.positional = frozenset(positional)
+        self.varkw = varkw is not None
+
+    def bind(self, params):
+        '''Returns a tuple ``(args, kwargs)`` of the values from ``params``
+        to pass to ``generate()``, after the response. ``params`` is not modified.
+
+        Raises ``ArgumentValidationError`` if any arguments without default
+        values are not present in ``params``.'''
+        args = []
+        missing = []
+        for name, has_default, default in self.arguments:
+            try:
+                args.append(params[name])
+            except KeyError:
+                if has_default:
+                    args.append(default)
+                else:
+                    missing.append(name)
+        if missing:
+            raise ArgumentValidationError(tuple(missing))
+        if self.varkw:
+            positional = self.positional
+            kwargs = dict((k, v) for k, v in params.iteritems() if k not in positional)
+        else:
+            kwargs = {}
+        return args, kwargs
 
 class ActionMetaclass(type):
     '''A metaclass that grants composition methods to the Action class itself.'''
@@ -118,6 +256,19 @@ class ActionMetaclass(type):
     __or__ = any_of
     __invert__ = opt
 
+    def __init__(self, name, bases, dct):
+        super(ActionMetaclass, self).__init__(name, bases, dct)
+        # work out once, rather than on every request, which parameters generate() takes
+        self.generate_signature = GenerateSignature.of(self.generate)
+        # handles_keys and handles_cacheable describe one particular handles(), so a
+        # class that replaces it (or a method it relies on) without declaring them
+        # again mustn't inherit them
+        if any(name in dct for name in self.handles_methods):
+            if 'handles_keys' not in dct:
+                self.handles_keys = None
+            if 'handles_cacheable' not in dct:
+                self.handles_cacheable = False
+
     # Python voodoo ;-) make Action() call Action.derive() and Action.handle() call Action()
     def __call__(self, *args, **kwargs):
         # create a subclass
@@ -126,13 +277,17 @@ class ActionMetaclass(type):
         return d
 
     def __str__(self):
-        if len(self.__name__) > 33 and self.__name__[-33] == '_':
+        name, serial = _derived_name(self)
+        if serial is not None:
             # it's a derived subclass
-            return '%-22s  [%s]' % (self.__name__[:-33], self.__name__[-32:])
+            return '%-22s  [%d]' % (name, serial)
         else:
-            return '%-22s   <standard>' % (self.__name__)
+            return '%-22s   <standard>' % (name)
 
     def handle(self, req, params):
+        instrument = req.environ.get('modulo.instrument')
+        if instrument is not None:
+            return instrument.handle(self, req, params)
         # construct a new Action
         h = super(ActionMetaclass, self).__call__(req, params)
         return h
@@ -155,6 +310,17 @@ class Action(object):
     # from handles(), but we need to have a way to skip them when they're optional.
     _opt = False
 
+    # The WSGI environment variables that the result of handles() depends on,
+    # or None if it might depend on anything, and whether the result for given
+    # values of those variables stays the same from one request to the next.
+    # See handles() for details.
+    handles_keys = None
+    handles_cacheable = False
+    # The methods that the result of handles() depends on. A subclass which
+    # defines any of them has to declare handles_keys and handles_cacheable
+    # itself, or they're reset to the defaults.
+    handles_methods = ('handles',)
+
     @classmethod
     def derive(cls, **kwargs):
         '''Returns a subclass of this class with selected class variables set.
@@ -177,11 +343,18 @@ class Action(object):
         class variables in some form.
         
         The subclass returned by ``derive()`` will have a name of the form
-        ``<class name>_<hash value>``, where ``<class name>` is the name of the base
-        class, and ``<hash value>`` is some deterministic function of the keys and
-        values passed in as keyword arguments. (The specific hash function used
-        is purposely undocumented and may change; in practice it should probably
-        never be necessary to know the hash generated.)
+        ``<class name>_<n>``, where ``<class name>`` is the name of the base
+        class, and ``<n>`` is a serial number. Deriving from the same class with
+        the same keyword arguments again gives back the same subclass, so an action
+        like ``ContentTypeAction('text/html')`` can be used in many places in a tree
+        without creating a new class each time. Arguments are compared by value if
+        they're hashable (strings, numbers, tuples, classes...) and by identity
+        otherwise (lists, dicts...).
+
+        Because of that, a derived class may be shared by unrelated parts of the
+        program, so don't change its class variables after it's been derived: after
+        ``Action.derive(foo='bar').foo = 'baz'``, every ``Action.derive(foo='bar')``
+        would have ``foo = 'baz'``. Derive a different class instead.
 
         If you write a subclass of Action that requires this sort of customization,
         and you don't have default values for the custom class variables, you can
@@ -201,7 +374,8 @@ class Action(object):
         
         In any case, you really should document which variables ``derive()`` accepts or
         requires for your class, if any.'''
-        return type('%s_%s' % (cls.__name__, hash_iterable(kwargs)), (cls,), kwargs)
+        key = tuple(sorted((k, _derivation_key(v)) for k, v in kwargs.iteritems()))
+        return _derive_class(cls, cls.__name__, key, kwargs)
 
     def __new__(cls, req, params):
         '''Creates an instance of an ``Action`` subclass ``cls``, if the class handles
@@ -211,11 +385,34 @@ class Action(object):
         with ``req`` and ``params``, this method will act like a normal constructor and
         return an instance of the class, customized to handle the given request. However,
         if ``cls`` doesn't handle the request, this will return ``None``.'''
-        if cls.handles(req, params):
+        if cls.handles_keys is None:
+            accepted = cls.handles(req, params)
+        else:
+            accepted = _memoized_handles(cls, req, params)
+        if accepted:
             return super(Action, cls).__new__(cls, req, params)
         else:
             return None
 
+    @classmethod
+    def branch_index(cls):
+        '''Returns a class which can be used to index branches of an :class:`AnyAction`
+        that start with this action, or ``None`` if there is no such class.
+
+        When one of the classes passed to :func:`any_of` is this action, or an
+        :func:`all_of` whose first element is this action, ``AnyAction`` can use
+        the index to rule out that branch without asking it to handle the request.
+        The index class gets instantiated with no arguments, and then for each branch
+        its ``add(position, action)`` method is called with the position of the branch
+        in the ``AnyAction`` and the action class (i.e. this class). For each request,
+        its ``candidates(req)`` method should return the positions of all branches whose
+        first action *might* handle the request, in any order. It's fine to return
+        branches that turn out not to handle the request, but a branch which isn't
+        returned will never be tried.
+
+        By default this returns ``None``, so branches are just tried in order.'''
+        return None
+
     @classmethod
     def handles(cls, req, params):
         '''Indicates whether this handler can handle the given request.
@@ -227,7 +424,31 @@ class Action(object):
         It should not have any side effects.
 
         The default behavior is to return True, so handlers will accept all requests
-        by default.'''
+        by default.
+
+        If the return value depends only on the class and on a few WSGI environment
+        variables (for example, if it just checks the URL path), you can list those
+        variables in the class attribute ``handles_keys``, e.g. ::
+
+            handles_keys = ('PATH_INFO',)
+
+        Then the result will be remembered for the duration of the request, and if
+        the same class is asked about the same request again, even in a different
+        branch of the action tree, ``handles()`` won't actually be called. Only do
+        this if ``handles()`` doesn't look at ``params`` or anything else that
+        could change while the request is being processed.
+
+        ``handles_keys`` only applies to the ``handles()`` of the class that declares
+        it. A subclass which overrides ``handles()`` (or another method listed in
+        ``handles_methods``) goes back to calling it for every action unless it
+        declares ``handles_keys`` again itself; the same goes for
+        ``handles_cacheable``.
+
+        If, in addition, the result for given values of those variables never changes
+        at all (unlike, say, checking whether a file exists), set the class attribute
+        ``handles_cacheable`` to ``True``. That allows a
+        :class:`~modulo.actions.dispatch.RoutingCache` to remember this action's
+        decision across requests.'''
         return True
 
     def __init__(self, req, params):
@@ -253,10 +474,9 @@ class Action(object):
                 assert isinstance(p, dict)
                 ns = getattr(self, 'namespace', '')
                 assert ns != '*', 'Need to implement namespace \'*\''
-                ns_params = params[ns].copy()
-                self.params = params.copy()
-                self.params[ns] = ns_params
-                ns_params.update(p)
+                if not isinstance(params, namespace_dict):
+                    params = namespace_dict(params)
+                self.params = params.layer(ns, p)
             else:
                 self.params = params
         else:
@@ -335,7 +555,8 @@ class Action(object):
         any If-Modified-Since sent by the client, and it's been determined that we
         do need to create and send a new response. This method can and should access
         its data from a cache if appropriate, rather than automatically running some
-        expensive database access or such every time.
+        expensive database access or such every time. (To cache the whole response,
+        wrap the actions that produce it in a :class:`~modulo.actions.cache.ResponseCache`.)
 
         generate() may return a dictionary which will be added to the parameter set.
 
@@ -344,12 +565,30 @@ class Action(object):
         pass
 
     def __str__(self):
-        cls = self.__class__
-        if len(cls.__name__) > 33 and cls.__name__[-33] == '_':
+        name, serial = _derived_name(self.__class__)
+        if serial is not None:
             # it's a derived subclass
-            return '%s [%s]' % (cls.__name__[:-33], cls.__name__[-32:])
+            return '%s [%d]' % (name, serial)
         else:
-            return '%s  <standard>' % (cls.__name__)
+            return '%s  <standard>' % (name)
+
+def _memoized_handles(cls, req, params):
+    '''Calls ``cls.handles(req, params)``, or returns the result of a previous call
+    for the same request if the variables listed in ``cls.handles_keys`` are the same.
+
+    The results are stored in the WSGI environment, so they're shared by the
+    modified copies of the environment that get created by :meth:`Action.transform`.'''
+    environ = req.environ
+    try:
+        memo = environ['modulo.handles']
+    except KeyError:
+        memo = environ['modulo.handles'] = {}
+    key = (cls,) + tuple(environ.get(k) for k in cls.handles_keys)
+    try:
+        return memo[key]
+    except KeyError:
+        accepted = memo[key] = cls.handles(req, params)
+        return accepted
 
 class HashKey(object):
     '''A surrogate key for objects which are not themselves hashable'''
@@ -370,6 +609,14 @@ class HashKey(object):
 accept_fmt = '%-60s accepting request %s'
 reject_fmt = '%-60s rejecting request %s'
 
+# The composite actions trace every decision they make at the DEBUG level.
+# Whether that's wanted is checked once per composite per request, and the
+# messages are only formatted if they'll actually be logged. All the tracing
+# code is also guarded by __debug__, so with -O the checks stop at that flag and
+# never ask the logger. (The tests still run; the compiler only removes a
+# plain "if __debug__:" block, not a condition like "__debug__ and debug".)
+log = logging.getLogger('modulo.actions')
+
 class AllActions(Action):
     @classmethod
     def handles(cls, req, params):
@@ -378,15 +625,18 @@ class AllActions(Action):
         return True
 
     def __new__(cls, req, params):
+        debug = __debug__ and log.isEnabledFor(logging.DEBUG)
         handlers = []
         for hc in cls.handler_classes:
             h = hc.handle(req, params)
             if h is None:
-                logging.getLogger('modulo.actions').debug(reject_fmt % (hc, req))
+                if __debug__ and debug:
+                    log.debug(reject_fmt, hc, req)
                 del req
                 return None
             elif isinstance(h, AllActions):
-                logging.getLogger('modulo.actions').debug(accept_fmt % (hc, req))
+                if __debug__ and debug:
+                    log.debug(accept_fmt, hc, req)
                 if h._opt:
                     for hndl in h.handlers:
                         hndl._opt = True
@@ -395,7 +645,8 @@ class AllActions(Action):
                 params = h.params
                 del h
             else:
-                logging.getLogger('modulo.actions').debug(accept_fmt % (hc, req))
+                if __debug__ and debug:
+                    log.debug(accept_fmt, hc, req)
                 handlers.append(h)
                 req = h.req
                 params = h.params
@@ -442,24 +693,28 @@ class AllActions(Action):
         return hash_iterable(filter(None, (h.action_id() for h in self.handlers)))
 
     def generate(self, rsp):
+        instrument = self.req.environ.get('modulo.instrument')
         for h in self.handlers:
             namespace = getattr(h, 'namespace', '')
-            params = self.params[''].copy()
             if namespace == '*':
+                params = wrap_dict(self.params[''])
                 for ns in self.params:
-                    if ns:
-                        for key in self.params[ns]:
-                            params[ns] = attribute_dict(self.params[ns])
+                    if ns and self.params[ns]:
+                        params[ns] = attribute_dict(self.params[ns].iteritems())
+            elif namespace:
+                params = wrap_dict(self.params[''], self.params[namespace])
             else:
-                if namespace:
-                    params.update(self.params[namespace])
+                params = self.params['']
             try:
-                hargs, hkwargs = validate_arguments(h.generate, [h, rsp], params, True)
+                hargs, hkwargs = h.generate_signature.bind(params)
             except ArgumentValidationError, e:
-                logging.getLogger('modulo.actions').exception('Missing arguments in handler %s: %s', h, tuple(e.missing))
+                log.exception('Missing arguments in handler %s: %s', h, tuple(e.missing))
                 raise
             try:
-                p = h.generate(rsp, *(hargs[2:]), **hkwargs)
+                if instrument is None:
+                    p = h.generate(rsp, *hargs, **hkwargs)
+                else:
+                    p = instrument.generate(h, rsp, *hargs, **hkwargs)
             except NotFound:
                 if not h._opt:
                     raise
@@ -470,20 +725,32 @@ class AllActions(Action):
                 self.params[''].update(hkwargs)
 
 class AnyAction(Action):
+    # Built the first time a request comes in, and rebuilt whenever the branches get sorted
+    _selector = None
+
     def __new__(cls, req, params):
-        for hc in cls.handler_classes[:]:
+        if cls._selector is None:
+            cls._selector = BranchSelector([hc[1] for hc in cls.handler_classes])
+        debug = __debug__ and log.isEnabledFor(logging.DEBUG)
+        handler_classes = cls.handler_classes[:]
+        for pos in cls._selector.candidates(req):
+            hc = handler_classes[pos]
             h = hc[1].handle(req, params)
             if h is None:
-                logging.getLogger('modulo.actions').debug(reject_fmt % (hc[1], req))
+                if __debug__ and debug:
+                    log.debug(reject_fmt, hc[1], req)
             else:
-                logging.getLogger('modulo.actions').debug(accept_fmt % (hc[1], req))
+                if __debug__ and debug:
+                    log.debug(accept_fmt, hc[1], req)
                 hc[0] += 1
                 if cls._sortable:
                     cls._count -= 1
                     if cls._count <= 0:
-                        logging.getLogger('modulo.actions').debug(str(cls) + ' sorting actions: ' + ','.join(str(h[0]) for h in cls.handler_classes))
+                        if __debug__ and debug:
+                            log.debug('%s sorting actions: %s', cls, ','.join(str(h[0]) for h in cls.handler_classes))
                         cls.handler_classes.sort(key=lambda h: h[0], reverse=True)
                         cls._count = sum(h[0] for h in cls.handler_classes)
+                        cls._selector = None
                 return h
         return None
         # Note that we never call super(...).__new__(...) here. So there is no
@@ -493,9 +760,13 @@ class OptAction(Action):
     def __new__(cls, req, params):
         h = cls.handler_class.handle(req, params)
         if h is None:
-            logging.getLogger('modulo.actions').debug(reject_fmt % (cls.handler_class, req))
+            if __debug__ and log.isEnabledFor(logging.DEBUG):
+                log.debug(reject_fmt, cls.handler_class, req)
             return Action.handle(req, params)
         else:
-            logging.getLogger('modulo.actions').debug(accept_fmt % (cls.handler_class, req))
+            if __debug__ and log.isEnabledFor(logging.DEBUG):
+                log.debug(accept_fmt, cls.handler_class, req)
             h._opt = True
             return h
+
+from modulo.actions.dispatch import BranchSelector
@@ -26,6 +26,8 @@ class BasicAuthentication(HTTPAuthentication):
     '''Handles HTTP basic authentication.
 
     This is meant to be subclassed.'''
+    handles_keys = ('HTTP_AUTHORIZATION',)
+
     @classmethod
     def handles(cls, req, params):
         auth = req.authorization
@@ -35,6 +37,8 @@ class DigestAuthentication(HTTPAuthentication):
     '''Handles HTTP digest authentication.
 
     This is meant to be subclassed.'''
+    handles_keys = ('HTTP_AUTHORIZATION',)
+
     @classmethod
     def handles(cls, req, params):
         auth = req.authorization
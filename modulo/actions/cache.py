@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+'''Caching of whole responses.
+
+:class:`ResponseCache` wraps an action tree, and saves the responses it
+produces so that later requests for the same page can be answered without
+running the tree at all: none of its actions get constructed, so nothing
+touches the database or the templates. ::
+
+    pages = ResponseCache(all_of(FetchAll(Post), MiniTemplate(filename='index.tmpl')),
+                          backend=MemoryCache(1000), timeout=60)
+    tree = all_of(ContentTypeAction('text/html'), pages)
+
+A response is identified by the request method, the URL scheme, the host, the
+path, the query string (with the arguments in sorted order), and the values of
+any WSGI environment variables listed in ``vary``. The status and body of the response are stored
+as they are when the last action in the wrapped tree is finished, along with
+the headers set by the wrapped tree. Headers set by actions outside the tree
+aren't stored, and are left alone when a cached response is used, so they can
+still be different for every request.
+
+Any cache from ``werkzeug.contrib.cache`` can be used as the backend, so
+besides :class:`MemoryCache`, which keeps responses in the process, responses
+can be stored on disk with ``FileSystemCache``, or in memcached with
+``MemcachedCache`` (which takes a list of servers, or a client object with the
+same interface as ``memcache.Client``).'''
+
+import logging
+import time
+import urllib
+from hashlib import md5
+from modulo.actions import Action, all_of
+from modulo.utilities import LRUCache
+from werkzeug.contrib.cache import BaseCache
+
+class MemoryCache(BaseCache):
+    '''A ``werkzeug.contrib.cache`` cache which keeps at most ``capacity`` items
+    in the memory of the process, throwing out the least recently used ones to
+    make room for new ones. It's safe to use from several threads at once.'''
+    def __init__(self, capacity=1000, default_timeout=300):
+        super(MemoryCache, self).__init__(default_timeout)
+        self.items = LRUCache(capacity)
+
+    def get(self, key):
+        entry = self.items.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.time():
+                return value
+        return None
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self.items[key] = (time.time() + timeout, value)
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        now = time.time()
+        # an expired item counts as missing
+        return self.items.add(key, (now + timeout, value), lambda entry: entry[0] <= now)
+
+    def delete(self, key):
+        self.items.discard(key)
+
+    def clear(self):
+        self.items.clear()
+
+class ResponseCache(Action):
+    '''An action which caches the responses produced by another action (usually
+    a whole tree) in ``backend``.
+
+    If a response for the request is in the cache, the wrapped action isn't used
+    at all; the cached status, headers, and body are put in the response instead.
+    Cached headers replace any headers with the same names, and other headers
+    already in the response are kept. ``Date`` and ``Set-Cookie`` are never
+    cached.
+    Otherwise the wrapped action handles the request as usual, and afterwards the
+    response is saved in the cache for ``timeout`` seconds, as long as its status
+    code is one of ``statuses`` and the wrapped action doesn't set any cookies.
+
+    Only ``GET`` and ``HEAD`` requests are cached. If ``condition`` is given, it's
+    called with the request, and the cache is only used if it returns true; for
+    example, it could check that the request doesn't come from a logged-in user.
+    ``vary`` lists the WSGI environment variables (e.g. ``HTTP_ACCEPT_LANGUAGE``)
+    that the response depends on, aside from the method and the URL (including
+    the scheme and host, so that sites sharing a backend don't mix up their
+    pages).'''
+    backend = None
+    timeout = 300
+    vary = ()
+    condition = None
+    statuses = (200,)
+    key_prefix = 'modulo.response:'
+
+    @classmethod
+    def derive(cls, handler_class, backend, condition=None, **kwargs):
+        if condition is not None:
+            kwargs['condition'] = staticmethod(condition)
+        # the mark is the first action in the tree, so it sees the headers set before
+        # the tree, and the store is the last, so it sees the finished response
+        return super(ResponseCache, cls).derive(handler_class=all_of(_MarkResponse, handler_class, _StoreResponse), backend=backend, **kwargs)
+
+    @classmethod
+    def cache_key(cls, req):
+        '''Returns the key under which the response to ``req`` is stored.'''
+        args = sorted((k.encode('utf-8'), v.encode('utf-8')) for k, v in req.args.iteritems(multi=True))
+        parts = [req.method, req.environ.get('wsgi.url_scheme', ''), req.host,
+                 (req.script_root + req.path).encode('utf-8'), urllib.urlencode(args)]
+        parts.extend(str(req.environ.get(k, '')) for k in cls.vary)
+        # hashed, because memcached only takes short keys without spaces
+        return cls.key_prefix + md5('\0'.join(parts)).hexdigest()
+
+    def __new__(cls, req, params):
+        if req.method not in ('GET', 'HEAD') or (cls.condition is not None and not cls.condition(req)):
+            return cls.handler_class.handle(req, params)
+        key = cls.cache_key(req)
+        entry = cls.backend.get(key)
+        if entry is not None:
+            logging.getLogger('modulo.actions.cache').debug('cache hit for %s', req.path)
+            h = super(ResponseCache, cls).__new__(cls, req, params)
+            h.entry = entry
+            return h
+        logging.getLogger('modulo.actions.cache').debug('cache miss for %s', req.path)
+        h = cls.handler_class.handle(req, params)
+        if h is not None:
+            mark, store = h.handlers[0], h.handlers[-1]
+            mark.store = store
+            store.cache = cls
+            store.key = key
+        return h
+
+    def generate(self, rsp):
+        status_code, headers, body = self.entry
+        rsp.status_code = status_code
+        for name in set(name for name, value in headers):
+            rsp.headers.remove(name)
+        for name, value in headers:
+            rsp.headers.add(name, value)
+        rsp.data = body
+
+# headers which belong to one response, and mustn't be repeated in another
+_uncached_headers = frozenset(['date', 'set-cookie'])
+
+class _MarkResponse(Action):
+    '''Notes which headers were in the response before the tree wrapped by a
+    :class:`ResponseCache` started.'''
+    # set by ResponseCache when the request can be cached
+    store = None
+
+    def generate(self, rsp):
+        if self.store is not None:
+            self.store.initial_headers = rsp.headers.items()
+
+class _StoreResponse(Action):
+    '''Saves the response in the cache of a :class:`ResponseCache`.'''
+    # set by ResponseCache when the request can be cached
+    cache = None
+    initial_headers = ()
+
+    def generate(self, rsp):
+        cache = self.cache
+        if cache is None or rsp.status_code not in cache.statuses:
+            return
+        # only the headers added or changed by the wrapped tree
+        initial = set(self.initial_headers)
+        headers = [(name, value) for name, value in rsp.headers.items() if (name, value) not in initial]
+        if any(name.lower() == 'set-cookie' for name, value in headers):
+            # the response was made for one visitor
+            return
+        headers = [(name, value) for name, value in headers if name.lower() not in _uncached_headers]
+        # reading data collects a streamed body into a list, so it can still be sent
+        cache.backend.set(self.key, (rsp.status_code, headers, rsp.data), cache.timeout)
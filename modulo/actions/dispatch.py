@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+'''Compilation of action trees into flat dispatch plans.
+
+Normally an action tree is processed by recursively calling
+:meth:`~modulo.actions.ActionMetaclass.handle` on the root class, which passes
+the request down through :class:`~modulo.actions.AllActions`,
+:class:`~modulo.actions.AnyAction`, and :class:`~modulo.actions.OptAction`
+until it reaches the individual actions at the leaves. This module provides
+an alternative: :func:`compile_tree` walks the tree once, when the application
+is set up, and flattens it into a :class:`DispatchPlan`, which is just a list
+of simple instructions executed by a single loop. The result of running the
+plan is the same as the result of handling the request with the tree itself,
+but none of the intermediate ``AllActions`` instances get created.
+
+A ``DispatchPlan`` has a :meth:`~DispatchPlan.handle` method just like an
+``Action`` subclass, so it can be used anywhere the root of an action tree
+would be used. Usually you don't need to create one yourself; just pass
+``compiled=True`` to :func:`~modulo.WSGIModuloApp`.'''
+
+import threading
+from modulo.actions import Action, AllActions, AnyAction, OptAction
+from modulo.utilities import LRUCache
+
+# Opcodes for the instructions in a plan. Each instruction is a tuple
+# (opcode, argument, target), where target is the index of the instruction
+# to jump to if the operation fails (or, for some opcodes, when it finishes).
+LEAF = 0        # handle the request with a single action class
+MARK_ANY = 1    # save the state and start trying the branches of an AnyAction
+COMMIT_ANY = 2  # a branch of an AnyAction succeeded (the argument is where the branch started)
+NEXT_ANY = 3    # a branch of an AnyAction failed, so try the next one
+MARK_OPT = 4    # save the state and start trying an optional action
+COMMIT_OPT = 5  # the optional action succeeded
+SKIP_OPT = 6    # the optional action failed, so restore the saved state
+FAIL = 7        # jump to the failure target, or reject the request if there is none
+DONE = 8        # accept the request
+OPT_LEAF = 9    # handle the request with a single optional action class
+
+def compile_tree(tree):
+    '''Returns a :class:`DispatchPlan` for the given action tree.
+
+    If ``tree`` is already a ``DispatchPlan``, it is returned unchanged.'''
+    if isinstance(tree, DispatchPlan):
+        return tree
+    return DispatchPlan(tree)
+
+def _is_composite(node, base):
+    # Only the composite classes created by all_of(), any_of(), and opt() can be
+    # flattened; anything that overrides __new__ has to be handled as a leaf.
+    return issubclass(node, base) and node.__new__ is base.__new__
+
+def routing_cacheable(cls):
+    '''Returns true if the decision made by ``cls`` about whether to handle a
+    request can be remembered from one request to the next.
+
+    That's the case if it uses the default :meth:`~modulo.actions.Action.handles`
+    and doesn't override ``__new__``, or if it declares both ``handles_keys`` and
+    ``handles_cacheable = True``. Those flags only count if they were declared
+    along with the ``handles()`` in use: a subclass which overrides ``handles()``
+    without declaring them again isn't cacheable.'''
+    if cls.__new__ is not Action.__new__:
+        return False
+    if cls.handles.im_func is Action.handles.im_func:
+        return True
+    return cls.handles_keys is not None and cls.handles_cacheable
+
+def _is_leaf(node):
+    # Whether node gets compiled into a single instruction
+    if _is_composite(node, AnyAction):
+        return getattr(node, '_sortable', False)
+    return not (_is_composite(node, AllActions) or _is_composite(node, OptAction))
+
+def _handle(cls, req, params):
+    return cls.handle(req, params)
+
+def _leading_action(node):
+    # The first action that gets asked to handle the request when node is
+    # handled, or None if that depends on more than one action
+    while _is_composite(node, AllActions):
+        if not node.handler_classes:
+            return None
+        node = node.handler_classes[0]
+    if _is_composite(node, AnyAction) or _is_composite(node, OptAction):
+        return None
+    return node
+
+class BranchSelector(object):
+    '''Picks out which branches of an :class:`~modulo.actions.AnyAction` are worth
+    trying for a given request.
+
+    Each branch is examined to find the first action it will ask to handle the
+    request. If that action has a :meth:`~modulo.actions.Action.branch_index`,
+    the branch gets added to an index of that type; for example, branches that
+    start with a :class:`~modulo.actions.filters.URIPrefixFilter` go into a
+    trie of path segments. Then, for each request, :meth:`candidates` asks the
+    indexes which branches could possibly accept it, so that the others can
+    be skipped without being tried. Branches that can't be indexed are always
+    candidates.
+
+    If fewer than two branches can be indexed, there's no point, so
+    :attr:`indexes` is left empty and every branch is a candidate.'''
+    def __init__(self, branches):
+        self.all = tuple(range(len(branches)))
+        self.unindexed = []
+        indexes = {}
+        for position, branch in enumerate(branches):
+            action = _leading_action(branch)
+            index_class = action and action.branch_index()
+            if index_class is None:
+                self.unindexed.append(position)
+            else:
+                if index_class not in indexes:
+                    indexes[index_class] = index_class()
+                indexes[index_class].add(position, action)
+        if len(branches) - len(self.unindexed) < 2:
+            self.unindexed = list(self.all)
+            indexes = {}
+        self.indexes = indexes.values()
+
+    def candidates(self, req):
+        '''Returns the positions of the branches which might accept ``req``, in order.'''
+        if not self.indexes:
+            return self.all
+        positions = set(self.unindexed)
+        for index in self.indexes:
+            positions.update(index.candidates(req))
+        return sorted(positions)
+
+class _Label(object):
+    '''A placeholder for an instruction index which isn't known yet.'''
+    __slots__ = ['index']
+    def __init__(self):
+        self.index = None
+
+class DispatchPlan(object):
+    '''A flattened representation of an action tree.
+
+    The plan is a list of instructions (``ops``) built once from the tree.
+    Processing a request means running through the instructions in order,
+    keeping track of the current request, the parameter set, and the list of
+    accepted action instances. When a choice point is reached (the branches
+    of an :class:`~modulo.actions.AnyAction` or the constituent class of an
+    :class:`~modulo.actions.OptAction`), the state is saved on a stack so that
+    it can be restored if the branch turns out not to handle the request.
+
+    The branches of each ``AnyAction`` are filtered through a
+    :class:`BranchSelector`, so that branches which can't possibly accept the
+    request aren't tried at all.
+
+    The actions at the leaves are constructed directly, without going through
+    :meth:`~modulo.actions.ActionMetaclass.handle`, unless the request is being
+    instrumented. If the tree is just a single action, there's nothing to gain,
+    and the plan hands the request to the tree.
+
+    Subclasses of ``AnyAction`` created with ``sortable=True`` reorder their
+    branches as requests come in, so they can't be flattened; they're kept in
+    the plan as single leaves and handled the normal way.'''
+    def __init__(self, tree):
+        self.tree = tree
+        if _is_composite(tree, AllActions):
+            self.instance_class = tree
+        else:
+            self.instance_class = AllActions
+        self.ops = []
+        self.leaves = {}
+        fail = _Label()
+        self._compile(tree, fail)
+        self._emit(DONE, None, None)
+        self._mark(fail)
+        self._emit(FAIL, None, None)
+        # replace the labels with the actual instruction indices
+        self.ops = [self._resolve(*i) for i in self.ops]
+        self.uncacheable = frozenset(pc for (pc, cls) in self.leaves.iteritems() if not routing_cacheable(cls))
+        self.single = _is_leaf(tree)
+
+    def _emit(self, op, arg, target):
+        self.ops.append((op, arg, target))
+
+    @staticmethod
+    def _resolve(op, arg, target):
+        if op == MARK_ANY:
+            starts, selector = arg
+            arg = (tuple(label.index for label in starts), selector)
+        elif op == COMMIT_ANY:
+            arg = arg.index
+        if isinstance(target, _Label):
+            target = target.index
+        return op, arg, target
+
+    def _mark(self, label):
+        label.index = len(self.ops)
+
+    def _compile(self, node, fail):
+        if _is_composite(node, AllActions):
+            if not node.handler_classes:
+                self._emit(FAIL, None, fail)
+            for hc in node.handler_classes:
+                self._compile(hc, fail)
+        elif _is_composite(node, AnyAction) and not getattr(node, '_sortable', False):
+            if not node.handler_classes:
+                self._emit(FAIL, None, fail)
+                return
+            end = _Label()
+            retry = _Label()
+            starts = [_Label() for hc in node.handler_classes]
+            selector = BranchSelector([hc for (count, hc) in node.handler_classes])
+            if not selector.indexes:
+                selector = None
+            self._emit(MARK_ANY, (starts, selector), fail)
+            for start, (count, hc) in zip(starts, node.handler_classes):
+                self._mark(start)
+                self._compile(hc, retry)
+                self._emit(COMMIT_ANY, start, end)
+            self._mark(retry)
+            self._emit(NEXT_ANY, None, fail)
+            self._mark(end)
+        elif _is_composite(node, OptAction) and _is_leaf(node.handler_class):
+            # the common case of opt() around a single action doesn't need the
+            # state saved, since there's nothing to undo if the action rejects
+            self.leaves[len(self.ops)] = node.handler_class
+            self._emit(OPT_LEAF, node.handler_class, None)
+        elif _is_composite(node, OptAction):
+            end = _Label()
+            skip = _Label()
+            self._emit(MARK_OPT, None, None)
+            self._compile(node.handler_class, skip)
+            self._emit(COMMIT_OPT, None, end)
+            self._mark(skip)
+            self._emit(SKIP_OPT, None, end)
+            self._mark(end)
+        else:
+            self.leaves[len(self.ops)] = node
+            self._emit(LEAF, node, fail)
+
+    def handle(self, req, params, route=None, trace=None):
+        '''Runs the plan for a request.
+
+        This returns the same thing the original action tree would: ``None``
+        if the request is rejected, otherwise a single action instance or an
+        instance of :class:`~modulo.actions.AllActions` containing all the
+        actions that accepted the request.
+
+        If ``trace`` is a list, the branches chosen at each ``AnyAction`` are
+        appended to it as the request is processed, along with ``None`` for
+        each action consulted whose decision can't be cached (according to
+        :func:`routing_cacheable`). A set of those branches can be passed back
+        as ``route`` for a later request, and then only the branches in the
+        set will be tried.'''
+        if self.single:
+            # there's nothing to flatten, so the tree can handle it just as well
+            if trace is not None and self.uncacheable:
+                trace.append(None)
+            return self.tree.handle(req, params)
+        ops = self.ops
+        handlers = []
+        stack = []
+        pc = 0
+        if req.environ.get('modulo.instrument') is None:
+            # skip ActionMetaclass.handle() and construct the actions directly
+            construct = type.__call__
+        else:
+            construct = _handle
+        while True:
+            op, arg, target = ops[pc]
+            if op == LEAF:
+                if trace is not None and pc in self.uncacheable:
+                    trace.append(None)
+                h = construct(arg, req, params)
+                if h is None:
+                    pc = target
+                    continue
+                if isinstance(h, AllActions):
+                    if h._opt:
+                        for hndl in h.handlers:
+                            hndl._opt = True
+                    handlers.extend(h.handlers)
+                else:
+                    handlers.append(h)
+                req = h.req
+                params = h.params
+                pc += 1
+            elif op == MARK_ANY:
+                starts, selector = arg
+                if route is not None:
+                    starts = [s for s in starts if s in route]
+                    if not starts:
+                        pc = target
+                        continue
+                elif selector is not None:
+                    starts = [starts[i] for i in selector.candidates(req)]
+                    if not starts:
+                        pc = target
+                        continue
+                branches = iter(starts)
+                stack.append((req, params, len(handlers), branches))
+                pc = branches.next()
+            elif op == NEXT_ANY:
+                req, params, n, branches = stack[-1]
+                del handlers[n:]
+                pc = next(branches, None)
+                if pc is None:
+                    stack.pop()
+                    pc = target
+            elif op == OPT_LEAF:
+                if trace is not None and pc in self.uncacheable:
+                    trace.append(None)
+                h = construct(arg, req, params)
+                if h is not None:
+                    if isinstance(h, AllActions):
+                        for hndl in h.handlers:
+                            hndl._opt = True
+                        handlers.extend(h.handlers)
+                    else:
+                        h._opt = True
+                        handlers.append(h)
+                    req = h.req
+                    params = h.params
+                pc += 1
+            elif op == MARK_OPT:
+                stack.append((req, params, len(handlers), None))
+                pc += 1
+            elif op == COMMIT_OPT:
+                n = stack.pop()[2]
+                for h in handlers[n:]:
+                    h._opt = True
+                pc = target
+            elif op == SKIP_OPT:
+                req, params, n, branches = stack.pop()
+                del handlers[n:]
+                pc = target
+            elif op == COMMIT_ANY:
+                stack.pop()
+                if trace is not None:
+                    trace.append(arg)
+                pc = target
+            elif op == DONE:
+                break
+            elif target is not None:
+                pc = target
+            else:
+                return None
+        if len(handlers) == 1:
+            return handlers[0]
+        elif len(handlers) == 0:
+            # everything was optional and nothing accepted the request
+            return Action.handle(req, params)
+        instance = object.__new__(self.instance_class)
+        for h in handlers:
+            h.req = req
+            h.params = params
+        instance.req = req
+        instance.params = params
+        instance.handlers = handlers
+        return instance
+
+    def __str__(self):
+        return 'DispatchPlan for %s (%d instructions)' % (self.tree, len(self.ops))
+
+class RoutingCache(object):
+    '''Remembers which branches of an action tree were chosen for recent requests.
+
+    This wraps a :class:`DispatchPlan` (compiling the tree if necessary). When a
+    request comes in, the cache looks up the request method, ``SCRIPT_NAME``,
+    ``PATH_INFO``, and every other WSGI environment variable listed in the
+    ``handles_keys`` of the actions in the tree. If a request with the same values
+    has been seen before, the plan is run with only the branches that were chosen
+    for that request, so none of the branches that rejected it are tried again.
+    Otherwise the plan is run normally and the chosen branches are remembered for
+    next time.
+
+    Only requests for which every action consulted was :func:`routing_cacheable`
+    get remembered. Any actions that do get run are still asked whether they
+    handle the request, so if the remembered route doesn't work out after all,
+    the request is just routed again from scratch.
+
+    The routes are kept in an :class:`~modulo.utilities.LRUCache` holding at most
+    ``size`` entries, and the number of requests that could and couldn't use a
+    remembered route are available as :attr:`hits` and :attr:`misses`. A request
+    whose remembered route didn't work out counts as a miss.
+
+    Like ``DispatchPlan``, ``RoutingCache`` has a :meth:`handle` method so it can be
+    used in place of the root of an action tree. Usually you'll want to create it by
+    passing ``routing_cache_size`` to :func:`~modulo.WSGIModuloApp`.'''
+    def __init__(self, tree, size=1000):
+        self.plan = compile_tree(tree)
+        keys = set()
+        for cls in self.plan.leaves.itervalues():
+            if routing_cacheable(cls) and cls.handles_keys:
+                keys.update(cls.handles_keys)
+        keys.difference_update(('REQUEST_METHOD', 'SCRIPT_NAME', 'PATH_INFO'))
+        self.keys = ('REQUEST_METHOD', 'SCRIPT_NAME', 'PATH_INFO') + tuple(sorted(keys))
+        self.routes = LRUCache(size)
+        # lookups which found a route that didn't work out
+        self.stale = 0
+        self.stale_lock = threading.Lock()
+
+    @property
+    def hits(self):
+        return self.routes.hits - self.stale
+
+    @property
+    def misses(self):
+        return self.routes.misses + self.stale
+
+    def handle(self, req, params):
+        environ = req.environ
+        key = tuple(environ.get(k) for k in self.keys)
+        route = self.routes.get(key)
+        if route is not None:
+            h = self.plan.handle(req, params, route=route)
+            if h is not None:
+                return h
+            self.routes.discard(key)
+            with self.stale_lock:
+                self.stale += 1
+        trace = []
+        h = self.plan.handle(req, params, trace=trace)
+        if h is not None and None not in trace:
+            self.routes[key] = frozenset(trace)
+        return h
+
+    def __str__(self):
+        return 'RoutingCache (%d hits, %d misses) for %s' % (self.hits, self.misses, self.plan.tree)
@@ -6,7 +6,7 @@ import weakref
 from types import ClassType
 from modulo.actions import Action, AllActions, HashKey
 from modulo.actions import accept_fmt, reject_fmt
-from modulo.utilities import environ_next, uri_path
+from modulo.utilities import environ_next, namespace_dict, uri_path
 from werkzeug import pop_path_info
 from werkzeug.exceptions import NotFound
 
@@ -26,25 +26,144 @@ class URIFilter(Action):
             another_action
         )
     '''
+    handles_keys = ('PATH_INFO',)
+    handles_cacheable = True
+
     @classmethod
     def handles(cls, req, params):
-        return bool(cls.__match(req.environ['PATH_INFO']))
+        return bool(cls.__match(req))
+
+    @classmethod
+    def branch_index(cls):
+        if cls.handles.im_func is URIFilter.handles.im_func and cls.__new__ is Action.__new__ and hasattr(cls, 'regex'):
+            return RegexIndex
+        return None
+
+    @classmethod
+    def __match(cls, req):
+        # The result is remembered for the request, so that handles() and
+        # parameters() only have to match the regex once between them
+        path = req.environ['PATH_INFO']
+        matches = _uri_matches(req)
+        try:
+            return matches[cls, path]
+        except KeyError:
+            match = matches[cls, path] = cls.compiled_regex().match(path)
+            return match
 
     @classmethod
-    def __match(cls, string):
+    def compiled_regex(cls):
         if isinstance(cls.regex, (str, unicode)):
             cls.regex = re.compile(cls.regex)
-        return cls.regex.match(string)
+        return cls.regex
 
     @classmethod
     def derive(cls, regex):
         return super(URIFilter, cls).derive(regex=regex)
 
     def parameters(self):
-        match = self.__match(self.req.environ['PATH_INFO'])
+        match = self.__match(self.req)
         if match.lastindex:
             return match.groupdict()
 
+def _uri_matches(req):
+    try:
+        return req.uri_matches
+    except AttributeError:
+        matches = req.uri_matches = {}
+        return matches
+
+# Patterns containing any of these can't be safely combined with other patterns:
+# numbered backreferences and conditionals refer to groups by position, and inline
+# flags apply to the whole combined pattern, not just one alternative.
+_uncombinable_re = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)')
+
+class _AlternativeMatch(object):
+    '''Makes the part of a match of a combined regex that corresponds to one
+    alternative look like a match of that alternative's own regex.'''
+    def __init__(self, match, first_group, last_group, names):
+        self.match = match
+        self.names = names
+        self.lastindex = None
+        for g in xrange(last_group, first_group, -1):
+            if match.start(g) != -1:
+                self.lastindex = g - first_group
+                break
+
+    def groupdict(self, default=None):
+        d = {}
+        for name in self.names:
+            value = self.match.group(name)
+            d[name] = default if value is None else value
+        return d
+
+class RegexIndex(object):
+    '''An index of the branches of an ``AnyAction`` which start with a :class:`URIFilter`.
+
+    The regular expressions of all the filters are combined into a single
+    alternation, ``(regex0)|(regex1)|...``, so that one call to ``match()``
+    finds the first branch whose filter accepts the path. The match is
+    remembered for the request, so the filter itself doesn't need to match
+    again, and all branches after that one are still returned as candidates in
+    case the rest of the selected branch doesn't handle the request.
+
+    Some regular expressions can't be combined, for instance if they use
+    backreferences or flags. Those are always returned as candidates. Also, if
+    two regular expressions use the same group name, or there are too many
+    groups for the ``re`` module to handle, a new alternation is started.'''
+    max_groups = 99
+
+    def __init__(self):
+        self.actions = []
+        self.chunks = None
+
+    def add(self, position, action):
+        self.actions.append((position, action))
+        self.chunks = None
+
+    def _build(self):
+        # This is done when the first request comes in rather than in add(),
+        # because the regular expressions might not have been compiled yet
+        self.chunks = []
+        self.always = []
+        patterns = []
+        alternatives = {}
+        names = set()
+        for position, action in self.actions:
+            regex = action.compiled_regex()
+            if regex.flags or _uncombinable_re.search(regex.pattern):
+                self.always.append(position)
+                continue
+            first_group = sum(a[2] - a[1] + 1 for a in alternatives.itervalues()) + 1
+            if names.intersection(regex.groupindex) or first_group + regex.groups > self.max_groups:
+                self._add_chunk(patterns, alternatives)
+                patterns, alternatives, names = [], {}, set()
+                first_group = 1
+            patterns.append('(%s)' % regex.pattern)
+            alternatives[first_group] = (position, first_group, first_group + regex.groups, tuple(regex.groupindex), action)
+            names.update(regex.groupindex)
+        self._add_chunk(patterns, alternatives)
+
+    def _add_chunk(self, patterns, alternatives):
+        if patterns:
+            positions = sorted(a[0] for a in alternatives.itervalues())
+            self.chunks.append((re.compile('|'.join(patterns)), alternatives, positions))
+
+    def candidates(self, req):
+        if self.chunks is None:
+            self._build()
+        path = req.environ['PATH_INFO']
+        found = list(self.always)
+        for combined, alternatives, positions in self.chunks:
+            match = combined.match(path)
+            if match is None:
+                continue
+            # the group enclosing the matched alternative is the last one to close
+            position, first_group, last_group, names, action = alternatives[match.lastindex]
+            _uri_matches(req)[action, path] = _AlternativeMatch(match, first_group, last_group, names)
+            found.extend(p for p in positions if p >= position)
+        return found
+
 class URIPrefixFilter(Action):
     '''A handler which only accepts requests with URIs starting with a string.
 
@@ -53,9 +172,18 @@ class URIPrefixFilter(Action):
     of the URI; this class uses str.startswith() instead of a regular expression.
     This is primarily intended to be chained with other handlers to make them apply
     only to a particular URI path, not for subclassing.'''
+    handles_keys = ('PATH_INFO',)
+    handles_cacheable = True
+
     @classmethod
     def handles(cls, req, params):
         return cls.__prefix(req.environ['PATH_INFO']) != False
+
+    @classmethod
+    def branch_index(cls):
+        if cls.handles.im_func is URIPrefixFilter.handles.im_func and cls.__new__ is Action.__new__ and hasattr(cls, 'prefixes'):
+            return PrefixIndex
+        return None
         
     @classmethod
     def __prefix(cls, path):
@@ -85,9 +213,18 @@ class URISuffixFilter(Action):
     of the URI; this class uses str.endswith() instead of a regular expression.
     This is primarily intended to be chained with other handlers to make them apply
     only to a particular URI path, not for subclassing.'''
+    handles_keys = ('PATH_INFO',)
+    handles_cacheable = True
+
     @classmethod
     def handles(cls, req, params):
         return cls.__suffix(req.environ['PATH_INFO']) != False
+
+    @classmethod
+    def branch_index(cls):
+        if cls.handles.im_func is URISuffixFilter.handles.im_func and cls.__new__ is Action.__new__ and hasattr(cls, 'suffixes'):
+            return SuffixIndex
+        return None
         
     @classmethod
     def __suffix(cls, path):
@@ -109,6 +246,81 @@ class URISuffixFilter(Action):
     def derive(cls, *suffixes, **kwargs):
         return super(URISuffixFilter, cls).derive(suffixes=suffixes, **kwargs)
 
+class PrefixIndex(object):
+    '''An index of the branches of an ``AnyAction`` which start with a
+    :class:`URIPrefixFilter` (or :class:`URIPrefixConsumer`).
+
+    The prefixes are stored in a trie keyed by path segment, so finding all the
+    prefixes that match a path takes time proportional to the number of segments in
+    the path, not the number of prefixes. This works because a prefix only matches
+    on a segment boundary: a prefix that doesn't end with a slash matches if its
+    segments are the first segments of the path, and a prefix that does end with a
+    slash matches if the path has at least one more segment after those.'''
+    def __init__(self):
+        # each node is a tuple (children, exact matches, directory matches)
+        self.root = ({}, [], [])
+
+    def add(self, position, action):
+        for prefix in action.prefixes:
+            segments = prefix.split('/')
+            if prefix.endswith('/'):
+                segments.pop()
+                slot = 2
+            else:
+                slot = 1
+            node = self.root
+            for segment in segments:
+                node = node[0].setdefault(segment, ({}, [], []))
+            node[slot].append(position)
+
+    def candidates(self, req):
+        segments = req.environ['PATH_INFO'].split('/')
+        last = len(segments) - 1
+        found = []
+        node = self.root
+        for i, segment in enumerate(segments):
+            node = node[0].get(segment)
+            if node is None:
+                break
+            found.extend(node[1])
+            if i < last:
+                found.extend(node[2])
+        return found
+
+class SuffixIndex(object):
+    '''An index of the branches of an ``AnyAction`` which start with a
+    :class:`URISuffixFilter` (or :class:`URISuffixConsumer`).
+
+    The suffixes are grouped by length, so finding all the suffixes that match a
+    path takes one dictionary lookup for each distinct suffix length.'''
+    def __init__(self):
+        self.lengths = {}
+        self.always = []
+
+    def add(self, position, action):
+        for suffix in action.suffixes:
+            if suffix:
+                # suffixes starting with . or / don't need to match on a segment boundary
+                loose = suffix[0] in './'
+                self.lengths.setdefault(len(suffix), {}).setdefault(suffix, []).append((position, loose))
+            else:
+                self.always.append(position)
+
+    def candidates(self, req):
+        path = req.environ['PATH_INFO']
+        found = list(self.always)
+        for length, suffixes in self.lengths.iteritems():
+            if length > len(path):
+                continue
+            for position, loose in suffixes.get(path[-length:], ()):
+                if loose:
+                    found.append(position)
+                else:
+                    url_suffix = path[:-length]
+                    if len(url_suffix) == 0 or url_suffix.endswith('/'):
+                        found.append(position)
+        return found
+
 class URIPrefixConsumer(URIPrefixFilter):
     '''A handler which only accepts requests with URIs starting with a string.
 
@@ -169,17 +381,14 @@ class WerkzeugMapFilter(Action):
         except NotFound: # don't let this exception propagate because another resource might handle the request
             return None
         else:
-            logging.getLogger('modulo.actions.filters').debug('WerkzeugMapFilter got endpoint ' + repr(endpoint))
+            logging.getLogger('modulo.actions.filters').debug('WerkzeugMapFilter got endpoint %r', endpoint)
             if not isinstance(endpoint, ClassType) or not issubclass(endpoint, Action):
                 endpoint = cls.action_map[endpoint]
             ns = getattr(cls, 'namespace', '') # namespace='*' is not implemented here
             if arguments:
-                ns_params = params[ns].copy()
-                params = params.copy()
-                params[ns] = ns_params
-                ns_params.update(arguments)
-            else:
-                ns_params = params[ns]
+                if not isinstance(params, namespace_dict):
+                    params = namespace_dict(params)
+                params = params.layer(ns, arguments)
             h = endpoint.handle(req, params)
             if h is None:
                 return None
@@ -44,6 +44,11 @@ class FileResource(Action):
 
     The point of the defaults being set up as they are is that FileResource by
     itself can be used as a static file server (albeit an inefficient one).'''
+    # This is only right as long as filename() only depends on the path. A subclass
+    # which overrides filename() has to declare handles_keys again to keep it.
+    handles_keys = ('PATH_INFO', 'DOCUMENT_ROOT')
+    handles_methods = ('handles', 'filename')
+
     @classmethod
     def derive(cls, filename=None, search_path=None, **kwargs):
         # search_path can be any iterable of strings, or a plain string
@@ -51,14 +56,17 @@ class FileResource(Action):
             return super(FileResource, cls).derive(search_path=search_path, **kwargs)
         elif isinstance(filename, basestring):
             if isabs(filename):
-                # In this case the filename is completely specified so we can replace the builtin filename() method
+                # In this case the filename is completely specified so we can replace the builtin filename() method.
+                # The replacement depends on nothing at all, so handles() can still be remembered.
+                kwargs.setdefault('handles_keys', cls.handles_keys)
                 return super(FileResource, cls).derive(filename=classmethod(lambda cls, req, params: filename), search_path=search_path, **kwargs)
             else:
                 # filename is a relative path, so don't replace the builtin filename
                 return super(FileResource, cls).derive(rel_filename=filename, search_path=search_path, **kwargs)
         else:
-            # Presumably filename is a callable which should replace the builtin filename() method
-            return super(FileResource, cls).derive(filename=filename, search_path=search_path, **kwargs)
+            # Presumably filename is a callable which should replace the builtin filename() method.
+            # We don't know what it depends on, so the result of handles() can't be remembered.
+            return super(FileResource, cls).derive(filename=filename, search_path=search_path, handles_keys=None, **kwargs)
 
     @classmethod
     def filename(cls, req, params):
@@ -134,6 +142,8 @@ class DirectoryIndex(Action):
     '''An action that alters the environment to insert a filename at the end of
     the requested path.'''
     index='index.html'
+    handles_keys = ('PATH_INFO',)
+    handles_cacheable = True
     
     @classmethod
     def derive(cls, index):
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+'''Per-action timing of requests.
+
+An :class:`Instrument` passed to :func:`~modulo.WSGIModuloApp` (or to
+:func:`~modulo.run_everything`) gets told how long each action took in each
+phase of handling a request:
+
+``handles``
+    deciding whether to handle the request, i.e. constructing the action, up to
+    but not including ``__init__``. For a composite action like an ``all_of``
+    this includes the time taken by all the actions it contains.
+``init``
+    the action's ``__init__``, which applies :meth:`~modulo.actions.Action.transform`
+    and :meth:`~modulo.actions.Action.parameters`
+``generate``
+    the action's :meth:`~modulo.actions.Action.generate` method
+
+as well as the total time for the request. :class:`Instrument` itself throws
+the numbers away; subclasses override :meth:`Instrument.record` and
+:meth:`Instrument.request_finished` to do something with them.
+:class:`TimingAggregator` is a ready-made subclass which keeps recent timings
+for each action class in memory and reports percentiles.
+
+When no instrument is in use, the only cost is one dictionary lookup each time
+an action is constructed.
+
+This module also provides :class:`SamplingProfiler`, which runs ``cProfile``
+on a random sample of requests, for when finer detail is needed.'''
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import threading
+from collections import deque
+from modulo import timer
+
+__all__ = ['Instrument', 'SamplingProfiler', 'TimingAggregator']
+
+class Instrument(object):
+    '''Receives the timings of the actions involved in each request.
+
+    The instrument in use for a request is stored in the WSGI environment under
+    the key ``modulo.instrument``, which is where the action classes find it.'''
+
+    def record(self, action_class, phase, seconds):
+        '''Called with the time taken by ``action_class`` in the given ``phase``,
+        one of ``'handles'``, ``'init'``, or ``'generate'``.'''
+        pass
+
+    def request_finished(self, request, seconds):
+        '''Called with the total time taken to process ``request``.'''
+        pass
+
+    def handle(self, cls, req, params):
+        '''Does the work of ``cls.handle(req, params)``, timing the construction
+        and initialization of the action separately.'''
+        t0 = timer()
+        h = cls.__new__(cls, req, params)
+        t1 = timer()
+        self.record(cls, 'handles', t1 - t0)
+        # this is what type.__call__ does
+        if isinstance(h, cls):
+            h.__init__(req, params)
+            self.record(cls, 'init', timer() - t1)
+        return h
+
+    def generate(self, handler, rsp, *args, **kwargs):
+        '''Calls ``handler.generate(rsp, *args, **kwargs)`` and records how long
+        it took, even if it raises an exception.'''
+        t0 = timer()
+        try:
+            return handler.generate(rsp, *args, **kwargs)
+        finally:
+            self.record(handler.__class__, 'generate', timer() - t0)
+
+class TimingAggregator(Instrument):
+    '''An instrument that keeps the most recent timings for each action class
+    and phase, and computes percentiles from them.
+
+    Only the last ``window`` timings for each action class and phase are kept,
+    so the percentiles describe recent behavior and memory use stays bounded.
+    The count, total time, and maximum are kept for all timings, so ``count``,
+    ``mean``, and ``max`` cover everything since the aggregator was created (or
+    cleared), while the percentiles only cover the last ``window``.
+    It's safe to use one aggregator for several threads at once.'''
+    percentiles = (50, 95, 99)
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        '''Forgets all the timings recorded so far.'''
+        with self.lock:
+            # (name, phase) -> [count, total, max, deque of recent timings]
+            self.samples = {}
+
+    def _add(self, key, seconds):
+        with self.lock:
+            try:
+                entry = self.samples[key]
+            except KeyError:
+                entry = self.samples[key] = [0, 0.0, seconds, deque(maxlen=self.window)]
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+            entry[3].append(seconds)
+
+    def record(self, action_class, phase, seconds):
+        self._add((action_class.__name__, phase), seconds)
+
+    def request_finished(self, request, seconds):
+        self._add(('request', 'total'), seconds)
+
+    def stats(self):
+        '''Returns a dict mapping each action class name to a dict which maps each
+        phase to a dict of statistics: ``count``, ``mean``, ``max``, and ``p50``,
+        ``p95``, and ``p99``. All times are in seconds. The percentiles are taken
+        from the last ``window`` timings only; the rest cover all timings. The
+        total time taken by whole requests is reported under the name ``request``
+        and phase ``total``.'''
+        with self.lock:
+            entries = [(key, entry[0], entry[1], entry[2], sorted(entry[3])) for key, entry in self.samples.iteritems()]
+        stats = {}
+        for (name, phase), count, total, longest, recent in entries:
+            s = {'count': count, 'mean': total / count, 'max': longest}
+            for p in self.percentiles:
+                # nearest-rank percentile
+                s['p%d' % p] = recent[max(0, (len(recent) * p + 99) // 100 - 1)]
+            stats.setdefault(name, {})[phase] = s
+        return stats
+
+    def to_json(self, **kwargs):
+        '''Returns the result of :meth:`stats` as a JSON string. Keyword arguments
+        are passed on to ``json.dumps()``.'''
+        return json.dumps(self.stats(), **kwargs)
+
+    def to_text(self):
+        '''Returns the result of :meth:`stats` as a table, with the slowest action
+        classes and phases (by 95th percentile) first and times in milliseconds.'''
+        rows = []
+        for name, phases in self.stats().iteritems():
+            for phase, s in phases.iteritems():
+                rows.append((s['p95'], name, phase, s))
+        rows.sort(reverse=True)
+        columns = ['p%d' % p for p in self.percentiles] + ['mean', 'max']
+        lines = ['%-40s %-9s %8s ' % ('action', 'phase', 'count') + ' '.join('%9s' % c for c in columns)]
+        for p95, name, phase, s in rows:
+            lines.append('%-40s %-9s %8d ' % (name, phase, s['count']) + ' '.join('%9.3f' % (s[c] * 1000) for c in columns))
+        return '\n'.join(lines)
+
+class SamplingProfiler(object):
+    '''Runs a random sample of requests under ``cProfile`` and saves the results.
+
+    Pass an instance of this class to :func:`~modulo.WSGIModuloApp` as ``profiler``.
+    Each request is profiled with probability ``fraction``, so that the cost of
+    profiling is only paid on a small part of the traffic. The statistics for the
+    profiled requests are grouped by URL and accumulated into files named
+    ``<group>.<n>.pstats`` in ``directory``, which can be loaded with the
+    ``pstats`` module. After ``requests_per_file`` requests in a group have been
+    profiled, ``n`` is incremented to start a new file, and only the ``keep``
+    most recent files for each group are kept.
+
+    Requests are grouped using ``patterns``, a sequence of ``(name, regex)``
+    pairs: a request goes in the group for the first regular expression that
+    matches the beginning of its path, or in the group ``other`` if none match.
+    If no patterns are given, requests are grouped by the first component of
+    their path (or ``root`` for the path ``/``).'''
+    def __init__(self, directory, fraction=0.01, patterns=None, requests_per_file=100, keep=5):
+        self.directory = directory
+        self.fraction = fraction
+        if patterns is None:
+            self.patterns = None
+        else:
+            self.patterns = [(name, re.compile(regex)) for name, regex in patterns]
+        self.requests_per_file = requests_per_file
+        self.keep = keep
+        self.lock = threading.Lock()
+        # group name -> [file number, requests in file, pstats.Stats]
+        self.groups = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def group(self, environ):
+        '''Returns the name of the group a request belongs to.'''
+        path = environ.get('PATH_INFO', '')
+        if self.patterns is None:
+            name = path.lstrip('/').split('/', 1)[0] or 'root'
+        else:
+            for name, regex in self.patterns:
+                if regex.match(path):
+                    break
+            else:
+                name = 'other'
+        return _unsafe_filename_chars.sub('_', name)
+
+    def wrap(self, app):
+        '''Returns a WSGI application which calls ``app``, profiling a sample
+        of the requests.'''
+        def profiling_middleware(environ, start_response):
+            if random.random() >= self.fraction:
+                return app(environ, start_response)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(app, environ, start_response)
+            finally:
+                self.save(self.group(environ), profile)
+        return profiling_middleware
+
+    def save(self, name, profile):
+        '''Adds the statistics from ``profile`` to the current file for the group
+        ``name``, starting a new file and removing old ones if necessary.'''
+        with self.lock:
+            try:
+                entry = self.groups[name]
+            except KeyError:
+                entry = self.groups[name] = [self._last_file(name) + 1, 0, None]
+            if entry[1] >= self.requests_per_file:
+                entry[0] += 1
+                entry[1] = 0
+                entry[2] = None
+                self._remove_old_files(name, entry[0])
+            if entry[2] is None:
+                entry[2] = pstats.Stats(profile)
+            else:
+                entry[2].add(profile)
+            entry[1] += 1
+            # rewrite the whole file each time, so nothing is lost if the process dies
+            entry[2].dump_stats(self._filename(name, entry[0]))
+
+    def _filename(self, name, n):
+        return os.path.join(self.directory, '%s.%d.pstats' % (name, n))
+
+    def _file_numbers(self, name):
+        numbers = []
+        prefix = name + '.'
+        for f in os.listdir(self.directory):
+            if f.startswith(prefix) and f.endswith('.pstats'):
+                n = f[len(prefix):-len('.pstats')]
+                if n.isdigit():
+                    numbers.append(int(n))
+        return numbers
+
+    def _last_file(self, name):
+        # continue numbering from files left by a previous run, without appending to them
+        return max(self._file_numbers(name) or [0])
+
+    def _remove_old_files(self, name, current):
+        for n in self._file_numbers(name):
+            if n <= current - self.keep:
+                try:
+                    os.remove(self._filename(name, n))
+                except OSError:
+                    pass
+
+_unsafe_filename_chars = re.compile(r'[^\w.-]')
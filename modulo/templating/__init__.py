@@ -1,19 +1,178 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
 from string import Template
+from UserDict import DictMixin
 
 from modulo.actions import Action
+from modulo.utilities import LRUCache
 
 class EmptyTemplateError(Exception):
     '''An exception to be raised when a template object is empty and produces no output.'''
     pass
 
+def set_output(rsp, output, stream=False):
+    '''Makes the rendered template ``output``, a string or an iterable of strings,
+    the body of the response ``rsp``.
+
+    If ``stream`` is true, the response is sent on as it's produced, without a
+    Content-Length header, so that for a big page the client starts getting data
+    before the rendering is finished and the whole page never has to be held in
+    memory at once. Only the engines that can render a template piece by piece
+    offer that, through a ``stream`` attribute on their actions (which can be
+    set with ``derive(stream=False)`` or ``derive(stream=True)``): Jinja, which
+    streams by default, and Genshi's :class:`~modulo.templating.genshi.GenshiStreamRenderer`,
+    which doesn't. The other engines produce the whole page as one string, so
+    they always send it with a Content-Length. If ``stream`` is false, the output
+    is collected into one string.'''
+    if stream:
+        if isinstance(output, basestring):
+            # an iterator rather than a list, or Werkzeug would add a Content-Length
+            output = iter([output])
+        rsp.response = output
+    else:
+        if not isinstance(output, basestring):
+            output = u''.join(output)
+        rsp.data = output
+
+class TemplateCache(object):
+    '''A bounded cache of compiled templates.
+
+    Each templating module keeps one of these, shared by all its actions, so that
+    a template is only compiled once no matter how many actions use it. At most
+    ``capacity`` templates are kept; when there are more, the least recently used
+    ones are thrown out. Templates are identified by their source or filename
+    only, so a cache should only be used for one kind of template.
+
+    Templates loaded from files are recompiled when the file's modification time
+    changes. To save a ``stat()`` call on every request, the modification time is
+    only checked if at least ``check_interval`` seconds have passed since the last
+    check (so the default of 0 means every time).'''
+    def __init__(self, capacity=100, check_interval=0):
+        self.templates = LRUCache(capacity)
+        self.check_interval = check_interval
+
+    def from_string(self, source, compile):
+        '''Returns the result of ``compile(source)``, compiling it only if the same
+        source hasn't been compiled recently.'''
+        # the source itself is the key; a string only computes its hash once
+        key = ('string', source)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = compile(source)
+        return template
+
+    def from_file(self, filename, compile):
+        '''Returns the result of ``compile(filename)``, compiling it only if the
+        file hasn't been compiled recently or has been modified since.'''
+        key = ('file', filename)
+        now = time.time()
+        entry = self.templates.get(key)
+        if entry is not None:
+            template, mtime, checked = entry
+            if now - checked < self.check_interval:
+                return template
+            current = os.stat(filename).st_mtime
+            if current == mtime:
+                entry[2] = now
+                return template
+        else:
+            current = os.stat(filename).st_mtime
+        template = compile(filename)
+        self.templates[key] = [template, current, now]
+        return template
+
+    def clear(self):
+        '''Throws away all the compiled templates.'''
+        self.templates.clear()
+
+class TemplateContext(DictMixin, object):
+    '''The variables a template gets to see: the parameters passed to the template
+    action, layered on top of the WSGI environment, without copying either one.
+
+    This is a read-only mapping. Looking up a name tries each layer in turn, so
+    parameters hide environment variables with the same name. If ``environ_keys``
+    is given, only those environment variables are visible, which keeps
+    templates from depending on server-specific variables and makes :meth:`copy`
+    cheaper.
+
+    Templating engines that can look names up in a chain of mappings (or in any
+    mapping) should be given :attr:`layers` or the context itself; for engines
+    that insist on a dict of their own, :meth:`copy` merges the layers.'''
+    def __init__(self, params, environ, environ_keys=None):
+        if environ_keys is not None:
+            environ = dict((k, environ[k]) for k in environ_keys if k in environ)
+        self.params = params
+        self.environ = environ
+        # highest priority first
+        self.layers = [params, environ]
+
+    @classmethod
+    def for_action(cls, action, params):
+        '''Returns the context for rendering a template in ``action``, which
+        can restrict the environment variables it passes to the template by
+        setting ``environ_keys``.'''
+        return cls(params, action.req.environ, getattr(action, 'environ_keys', None))
+
+    def with_defaults(self, defaults):
+        '''Returns a context with ``defaults`` added as a new lowest layer.'''
+        context = self.__class__.__new__(self.__class__)
+        context.params = self.params
+        context.environ = self.environ
+        context.layers = self.layers + [defaults]
+        return context
+
+    def __getitem__(self, key):
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        for layer in self.layers:
+            if key in layer:
+                return True
+        return False
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        return default
+
+    def keys(self):
+        keys = set()
+        for layer in self.layers:
+            keys.update(layer)
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __setitem__(self, key, value):
+        raise TypeError('template contexts are read-only')
+
+    def __delitem__(self, key):
+        raise TypeError('template contexts are read-only')
+
+    def copy(self):
+        '''Returns a new dict containing everything visible in this context.'''
+        d = {}
+        for layer in reversed(self.layers):
+            d.update(layer)
+        return d
+
 class PythonTemplate(Action):
     namespace='*'
     @classmethod
     def derive(cls, template, **kwargs):
         if isinstance(template, basestring):
             template = Template(template)
-        return super(PythonTemplate, cls).derive(template=template)
+        return super(PythonTemplate, cls).derive(template=template, **kwargs)
     def generate(self, rsp, **kwargs):
-        rsp.data = self.template.substitute(kwargs)
+        set_output(rsp, self.template.substitute(kwargs))
@@ -5,18 +5,35 @@ from __future__ import absolute_import
 from Cheetah.Template import Template
 from modulo.actions import Action
 from modulo.actions.standard import FileResource
+from modulo.templating import TemplateCache, TemplateContext, set_output
 from os.path import join
 
+# Template classes compiled from source by the Cheetah actions. Compiling is
+# the slow part; once a template has been compiled into a class, rendering it
+# for a request is just a matter of creating an instance with a new searchList,
+# which is what CheetahCompiledTemplate does.
+template_cache = TemplateCache()
+
+def compile_source(source):
+    return Template.compile(source=source)
+
+def compile_file(filename):
+    # Cheetah is not Unicode-aware, apparently, so we need to str(filename)
+    return Template.compile(file=str(filename))
+
 class CheetahStringTemplate(Action):
     namespace = '*'
+    cache = template_cache
     def generate(self, rsp, **kwargs):
-        rsp.data = str(Template(source=self.template, searchList=[self.req.environ, kwargs]))
+        template = self.cache.from_string(self.template, compile_source)
+        set_output(rsp, str(template(searchList=TemplateContext.for_action(self, kwargs).layers)))
 
 class CheetahFilesystemTemplate(FileResource):
     namespace = '*'
+    cache = template_cache
     def generate(self, rsp, **kwargs):
-        # Cheetah is not Unicode-aware, apparently, so we need to str(self.filename)
-        rsp.data = str(Template(file=str(self.filename), searchList=[self.req.environ, kwargs]))
+        template = self.cache.from_file(self.filename, compile_file)
+        set_output(rsp, str(template(searchList=TemplateContext.for_action(self, kwargs).layers)))
 
 class CheetahCompiledTemplate(Action):
     '''Represents a compiled Cheetah template.'''
@@ -55,4 +72,4 @@ class CheetahCompiledTemplate(Action):
         return super(CheetahCompiledTemplate, cls).derive(template=template, **kwargs)
 
     def generate(self, rsp, **kwargs):
-        rsp.data = str(self.template(searchList=[self.req.environ, kwargs]))
+        set_output(rsp, str(self.template(searchList=TemplateContext.for_action(self, kwargs).layers)))
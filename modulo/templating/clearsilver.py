@@ -9,16 +9,54 @@ import time
 from elixir import Entity
 from modulo.actions import Action
 from modulo.actions.standard import FileResource
-from modulo.templating import EmptyTemplateError
-from modulo.utilities import compact, environ_next
+from modulo.templating import EmptyTemplateError, TemplateCache, set_output
+from modulo.utilities import LRUCache, compact, environ_next
+from sqlalchemy.orm import ColumnProperty
+
+# Parsed HDF data files, proxies made from HDF data files, and template sources
+# shared by the Clearsilver actions. Each kind gets a cache of its own, because
+# the same file can be loaded by more than one kind of action. Files are only
+# checked for changes if it's been check_interval seconds since the last check,
+# so set the caches' check_interval to suit (0 checks on every request). Only
+# the modification time of the file itself is checked, not of any files it
+# includes.
+hdf_cache = TemplateCache(check_interval=2)
+hdf_proxy_cache = TemplateCache(check_interval=2)
+template_cache = TemplateCache(check_interval=2)
+
+def read_hdf(filename):
+    '''Parses an HDF data file into a new HDF object.'''
+    logging.getLogger('modulo.templating.clearsilver').debug('loading file %s', filename)
+    hdf = neo_util.HDF()
+    hdf.readFile(filename)
+    return hdf
+
+def read_source(filename):
+    '''Reads the source of a Clearsilver template.'''
+    logging.getLogger('modulo.templating.clearsilver').debug('loading file %s', filename)
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
 
 class ClearsilverDataFile(FileResource):
-    '''An Action that loads a Clearsilver data file into the HDF.'''
+    '''An Action that loads a Clearsilver data file into the HDF.
+
+    The file is parsed once and kept in :data:`hdf_cache`, and its contents are
+    copied into the HDF for each request. If load paths have been set in the HDF
+    (by :class:`ClearsilverLoadPath`), the file is read straight into the HDF
+    instead, so that its ``#include`` lines are resolved using them.'''
+    cache = hdf_cache
     def generate(self, rsp, hdf=None):
         if hdf is None:
             hdf = neo_util.HDF()
-        logging.getLogger('modulo.templating.clearsilver').debug('loading file ' + self.filename)
-        hdf.readFile(self.filename)
+        if hdf.getObj('hdf.loadpaths') is not None:
+            logging.getLogger('modulo.templating.clearsilver').debug('loading file %s', self.filename)
+            hdf.readFile(self.filename)
+        else:
+            # copies the values of the top-level nodes as well as everything under them
+            hdf.copy('', self.cache.from_file(self.filename, read_hdf))
         return compact('hdf')
 
     @classmethod
@@ -51,29 +89,38 @@ class _hdfproxy(object):
         except KeyError:
             raise AttributeError(name)
 
+def read_hdf_proxies(filename):
+    '''Parses an HDF data file into a dict mapping the names of its top-level
+    nodes to proxy objects.'''
+    return dict((node.name(), _hdfproxy(node)) for node in hdf_iterate(read_hdf(filename)))
+
 class HDFDataFile(FileResource):
-    '''An Action that loads an HDF data file into the parameter list.'''
+    '''An Action that loads an HDF data file into the parameter list.
+
+    The proxy objects made from the file are kept in :data:`hdf_proxy_cache`
+    and shared between requests.'''
+    cache = hdf_proxy_cache
     def generate(self, rsp):
-        hdf = neo_util.HDF() # temp object
-        logging.getLogger('modulo.templating.clearsilver').debug('loading file ' + self.filename)
-        hdf.readFile(self.filename)
-        data = {}
-        for node in hdf_iterate(hdf):
-            data[node.name()] = _hdfproxy(node)
-        return data
+        # the proxies are never modified, but the dict could be
+        return dict(self.cache.from_file(self.filename, read_hdf_proxies))
 
     @classmethod
     def filename(cls, req, params):
         return super(HDFDataFile, cls).filename(req, params) + '.hdf'
 
 class ClearsilverTemplate(FileResource):
+    '''An Action that parses a Clearsilver template, for :class:`ClearsilverRendering`.
+
+    The parse tree belongs to the ``CS`` object, which is tied to the request's
+    HDF, so the template is parsed for each request; but its source is kept in
+    :data:`template_cache` so the file isn't read each time.'''
+    cache = template_cache
     def generate(self, rsp, hdf=None, cs=None):
         if hdf is None:
             hdf = neo_util.HDF()
         if cs is None:
             cs = neo_cs.CS(hdf)
-        logging.getLogger('modulo.templating.clearsilver').debug('loading file ' + self.filename)
-        cs.parseFile(self.filename)
+        cs.parseStr(self.cache.from_file(self.filename, read_source))
         return compact('hdf', 'cs')
 
     @classmethod
@@ -103,185 +150,226 @@ def default_fmt(k, v):
     return str(v)
 
 class ClearsilverRendering(Action):
+    '''Renders the template parsed by :class:`ClearsilverTemplate`, after putting
+    the parameters in the HDF.
+
+    Like the Clearsilver CGI kit, this also puts data about the request in the
+    subtrees ``CGI``, ``HTTP``, ``Cookie``, ``Session``, and ``common`` of the
+    HDF. If a template doesn't use all of them, pass the ones it does use as
+    ``hdf_subtrees`` to skip the others; in particular, leaving out ``Session``
+    means the session doesn't have to be loaded.
+
+    Model objects among the parameters are converted to dicts before they're
+    put in the HDF. If ``model_cache`` is given, it should be a
+    :class:`ModelDictCache`, which lets the dicts be reused between requests.'''
     namespace = '*'
     fmt=staticmethod(default_fmt)
+    hdf_subtrees = ('CGI', 'HTTP', 'Cookie', 'Session', 'common')
+    # set this to a ModelDictCache to reuse the dicts made from model objects
+    model_cache = None
     def generate(self, rsp, hdf, cs, **kwargs):
         # emulate the Clearsilver CGI kit
-        load_hdf_cgi_vars(self.req, hdf)
-        load_hdf_cookie_vars(self.req, hdf)
-        load_hdf_session_vars(self.req, hdf)
-        load_hdf_common_vars(self.req, hdf)
-        hdf_insert_dict(hdf, kwargs, '', fmt=self.fmt)
+        subtrees = self.hdf_subtrees
+        if 'CGI' in subtrees or 'HTTP' in subtrees:
+            load_hdf_cgi_vars(self.req, hdf, subtrees)
+        if 'Cookie' in subtrees:
+            load_hdf_cookie_vars(self.req, hdf)
+        if 'Session' in subtrees:
+            load_hdf_session_vars(self.req, hdf)
+        if 'common' in subtrees:
+            load_hdf_common_vars(self.req, hdf)
+        hdf_insert_dict(hdf, kwargs, '', fmt=self.fmt, cache=self.model_cache)
         output = cs.render()
         if not output:
             raise EmptyTemplateError, 'Clearsilver template produced no output'
-        rsp.data = output
+        set_output(rsp, output)
 
-def load_hdf_cgi_vars(req, hdf):
-    '''Load request data into the HDF as is done by the CGI kit.
-
-    This method loads the HTTP headers and CGI environment variables.'''
-    def transfer_to_hdf(cgi_name, hdf_name):
-        if cgi_name in req.environ:
-            hdf.setValue(hdf_name, str(req.environ[cgi_name]))
-    # this list is copied right out of Clearsilver's cgi/cgi.c
-    transfer_to_hdf('AUTH_TYPE', 'CGI.AuthType')
-    transfer_to_hdf('CONTENT_TYPE', 'CGI.ContentType')
-    transfer_to_hdf('CONTENT_LENGTH', 'CGI.ContentLength')
-    transfer_to_hdf('DOCUMENT_ROOT', 'CGI.DocumentRoot')
-    transfer_to_hdf('GATEWAY_INTERFACE', 'CGI.GatewayInterface')
-    transfer_to_hdf('PATH_INFO', 'CGI.PathInfo')
-    transfer_to_hdf('PATH_TRANSLATED', 'CGI.PathTranslated')
-    transfer_to_hdf('QUERY_STRING', 'CGI.QueryString')
-    transfer_to_hdf('REDIRECT_REQUEST', 'CGI.RedirectRequest')
-    transfer_to_hdf('REDIRECT_QUERY_STRING', 'CGI.RedirectQueryString')
-    transfer_to_hdf('REDIRECT_STATUS', 'CGI.RedirectStatus')
-    transfer_to_hdf('REDIRECT_URL', 'CGI.RedirectURL')
-    transfer_to_hdf('REMOTE_ADDR', 'CGI.RemoteAddress')
-    transfer_to_hdf('REMOTE_HOST', 'CGI.RemoteHost')
-    transfer_to_hdf('REMOTE_IDENT', 'CGI.RemoteIdent')
-    transfer_to_hdf('REMOTE_PORT', 'CGI.RemotePort')
-    transfer_to_hdf('REMOTE_USER', 'CGI.RemoteUser')
-    transfer_to_hdf('REMOTE_GROUP', 'CGI.RemoteGroup')
-    transfer_to_hdf('REQUEST_METHOD', 'CGI.RequestMethod')
-    transfer_to_hdf('REQUEST_URI', 'CGI.RequestURI')
-    transfer_to_hdf('SCRIPT_FILENAME', 'CGI.ScriptFilename')
-    transfer_to_hdf('SCRIPT_NAME', 'CGI.ScriptName')
-    transfer_to_hdf('SERVER_ADDR', 'CGI.ServerAddress')
-    transfer_to_hdf('SERVER_ADMIN', 'CGI.ServerAdmin')
-    transfer_to_hdf('SERVER_NAME', 'CGI.ServerName')
-    transfer_to_hdf('SERVER_PORT', 'CGI.ServerPort')
-    transfer_to_hdf('SERVER_ROOT', 'CGI.ServerRoot')
-    transfer_to_hdf('SERVER_PROTOCOL', 'CGI.ServerProtocol')
-    transfer_to_hdf('SERVER_SOFTWARE', 'CGI.ServerSoftware')
+# The CGI environment variables and HTTP headers that the Clearsilver CGI kit
+# puts in the HDF, and where it puts them.
+# this list is copied right out of Clearsilver's cgi/cgi.c
+cgi_vars = (
+    ('AUTH_TYPE', 'CGI.AuthType'),
+    ('CONTENT_TYPE', 'CGI.ContentType'),
+    ('CONTENT_LENGTH', 'CGI.ContentLength'),
+    ('DOCUMENT_ROOT', 'CGI.DocumentRoot'),
+    ('GATEWAY_INTERFACE', 'CGI.GatewayInterface'),
+    ('PATH_INFO', 'CGI.PathInfo'),
+    ('PATH_TRANSLATED', 'CGI.PathTranslated'),
+    ('QUERY_STRING', 'CGI.QueryString'),
+    ('REDIRECT_REQUEST', 'CGI.RedirectRequest'),
+    ('REDIRECT_QUERY_STRING', 'CGI.RedirectQueryString'),
+    ('REDIRECT_STATUS', 'CGI.RedirectStatus'),
+    ('REDIRECT_URL', 'CGI.RedirectURL'),
+    ('REMOTE_ADDR', 'CGI.RemoteAddress'),
+    ('REMOTE_HOST', 'CGI.RemoteHost'),
+    ('REMOTE_IDENT', 'CGI.RemoteIdent'),
+    ('REMOTE_PORT', 'CGI.RemotePort'),
+    ('REMOTE_USER', 'CGI.RemoteUser'),
+    ('REMOTE_GROUP', 'CGI.RemoteGroup'),
+    ('REQUEST_METHOD', 'CGI.RequestMethod'),
+    ('REQUEST_URI', 'CGI.RequestURI'),
+    ('SCRIPT_FILENAME', 'CGI.ScriptFilename'),
+    ('SCRIPT_NAME', 'CGI.ScriptName'),
+    ('SERVER_ADDR', 'CGI.ServerAddress'),
+    ('SERVER_ADMIN', 'CGI.ServerAdmin'),
+    ('SERVER_NAME', 'CGI.ServerName'),
+    ('SERVER_PORT', 'CGI.ServerPort'),
+    ('SERVER_ROOT', 'CGI.ServerRoot'),
+    ('SERVER_PROTOCOL', 'CGI.ServerProtocol'),
+    ('SERVER_SOFTWARE', 'CGI.ServerSoftware'),
     # SSL Vars from mod_ssl
-    transfer_to_hdf('HTTPS', 'CGI.HTTPS')
-    transfer_to_hdf('SSL_PROTOCOL', 'CGI.SSL.Protocol')
-    transfer_to_hdf('SSL_SESSION_ID', 'CGI.SSL.SessionID')
-    transfer_to_hdf('SSL_CIPHER', 'CGI.SSL.Cipher')
-    transfer_to_hdf('SSL_CIPHER_EXPORT', 'CGI.SSL.Cipher.Export')
-    transfer_to_hdf('SSL_CIPHER_USEKEYSIZE', 'CGI.SSL.Cipher.UseKeySize')
-    transfer_to_hdf('SSL_CIPHER_ALGKEYSIZE', 'CGI.SSL.Cipher.AlgKeySize')
-    transfer_to_hdf('SSL_VERSION_INTERFACE', 'CGI.SSL.Version.Interface')
-    transfer_to_hdf('SSL_VERSION_LIBRARY', 'CGI.SSL.Version.Library')
-    transfer_to_hdf('SSL_CLIENT_M_VERSION', 'CGI.SSL.Client.M.Version')
-    transfer_to_hdf('SSL_CLIENT_M_SERIAL', 'CGI.SSL.Client.M.Serial')
-    transfer_to_hdf('SSL_CLIENT_S_DN', 'CGI.SSL.Client.S.DN')
-    transfer_to_hdf('SSL_CLIENT_S_DN_x509', 'CGI.SSL.Client.S.DN.x509')
-    transfer_to_hdf('SSL_CLIENT_I_DN', 'CGI.SSL.Client.I.DN')
-    transfer_to_hdf('SSL_CLIENT_I_DN_x509', 'CGI.SSL.Client.I.DN.x509')
-    transfer_to_hdf('SSL_CLIENT_V_START', 'CGI.SSL.Client.V.Start')
-    transfer_to_hdf('SSL_CLIENT_V_END', 'CGI.SSL.Client.V.End')
-    transfer_to_hdf('SSL_CLIENT_A_SIG', 'CGI.SSL.Client.A.SIG')
-    transfer_to_hdf('SSL_CLIENT_A_KEY', 'CGI.SSL.Client.A.KEY')
-    transfer_to_hdf('SSL_CLIENT_CERT', 'CGI.SSL.Client.CERT')
-    transfer_to_hdf('SSL_CLIENT_CERT_CHAINn', 'CGI.SSL.Client.CERT.CHAINn')
-    transfer_to_hdf('SSL_CLIENT_VERIFY', 'CGI.SSL.Client.Verify')
-    transfer_to_hdf('SSL_SERVER_M_VERSION', 'CGI.SSL.Server.M.Version')
-    transfer_to_hdf('SSL_SERVER_M_SERIAL', 'CGI.SSL.Server.M.Serial')
-    transfer_to_hdf('SSL_SERVER_S_DN', 'CGI.SSL.Server.S.DN')
-    transfer_to_hdf('SSL_SERVER_S_DN_x509', 'CGI.SSL.Server.S.DN.x509')
-    transfer_to_hdf('SSL_SERVER_S_DN_CN', 'CGI.SSL.Server.S.DN.CN')
-    transfer_to_hdf('SSL_SERVER_S_DN_EMAIL', 'CGI.SSL.Server.S.DN.Email')
-    transfer_to_hdf('SSL_SERVER_S_DN_O', 'CGI.SSL.Server.S.DN.O')
-    transfer_to_hdf('SSL_SERVER_S_DN_OU', 'CGI.SSL.Server.S.DN.OU')
-    transfer_to_hdf('SSL_SERVER_S_DN_C', 'CGI.SSL.Server.S.DN.C')
-    transfer_to_hdf('SSL_SERVER_S_DN_SP', 'CGI.SSL.Server.S.DN.SP')
-    transfer_to_hdf('SSL_SERVER_S_DN_L', 'CGI.SSL.Server.S.DN.L')
-    transfer_to_hdf('SSL_SERVER_I_DN', 'CGI.SSL.Server.I.DN')
-    transfer_to_hdf('SSL_SERVER_I_DN_x509', 'CGI.SSL.Server.I.DN.x509')
-    transfer_to_hdf('SSL_SERVER_I_DN_CN', 'CGI.SSL.Server.I.DN.CN')
-    transfer_to_hdf('SSL_SERVER_I_DN_EMAIL', 'CGI.SSL.Server.I.DN.Email')
-    transfer_to_hdf('SSL_SERVER_I_DN_O', 'CGI.SSL.Server.I.DN.O')
-    transfer_to_hdf('SSL_SERVER_I_DN_OU', 'CGI.SSL.Server.I.DN.OU')
-    transfer_to_hdf('SSL_SERVER_I_DN_C', 'CGI.SSL.Server.I.DN.C')
-    transfer_to_hdf('SSL_SERVER_I_DN_SP', 'CGI.SSL.Server.I.DN.SP')
-    transfer_to_hdf('SSL_SERVER_I_DN_L', 'CGI.SSL.Server.I.DN.L')
-    transfer_to_hdf('SSL_SERVER_V_START', 'CGI.SSL.Server.V.Start')
-    transfer_to_hdf('SSL_SERVER_V_END', 'CGI.SSL.Server.V.End')
-    transfer_to_hdf('SSL_SERVER_A_SIG', 'CGI.SSL.Server.A.SIG')
-    transfer_to_hdf('SSL_SERVER_A_KEY', 'CGI.SSL.Server.A.KEY')
-    transfer_to_hdf('SSL_SERVER_CERT', 'CGI.SSL.Server.CERT')
+    ('HTTPS', 'CGI.HTTPS'),
+    ('SSL_PROTOCOL', 'CGI.SSL.Protocol'),
+    ('SSL_SESSION_ID', 'CGI.SSL.SessionID'),
+    ('SSL_CIPHER', 'CGI.SSL.Cipher'),
+    ('SSL_CIPHER_EXPORT', 'CGI.SSL.Cipher.Export'),
+    ('SSL_CIPHER_USEKEYSIZE', 'CGI.SSL.Cipher.UseKeySize'),
+    ('SSL_CIPHER_ALGKEYSIZE', 'CGI.SSL.Cipher.AlgKeySize'),
+    ('SSL_VERSION_INTERFACE', 'CGI.SSL.Version.Interface'),
+    ('SSL_VERSION_LIBRARY', 'CGI.SSL.Version.Library'),
+    ('SSL_CLIENT_M_VERSION', 'CGI.SSL.Client.M.Version'),
+    ('SSL_CLIENT_M_SERIAL', 'CGI.SSL.Client.M.Serial'),
+    ('SSL_CLIENT_S_DN', 'CGI.SSL.Client.S.DN'),
+    ('SSL_CLIENT_S_DN_x509', 'CGI.SSL.Client.S.DN.x509'),
+    ('SSL_CLIENT_I_DN', 'CGI.SSL.Client.I.DN'),
+    ('SSL_CLIENT_I_DN_x509', 'CGI.SSL.Client.I.DN.x509'),
+    ('SSL_CLIENT_V_START', 'CGI.SSL.Client.V.Start'),
+    ('SSL_CLIENT_V_END', 'CGI.SSL.Client.V.End'),
+    ('SSL_CLIENT_A_SIG', 'CGI.SSL.Client.A.SIG'),
+    ('SSL_CLIENT_A_KEY', 'CGI.SSL.Client.A.KEY'),
+    ('SSL_CLIENT_CERT', 'CGI.SSL.Client.CERT'),
+    ('SSL_CLIENT_CERT_CHAINn', 'CGI.SSL.Client.CERT.CHAINn'),
+    ('SSL_CLIENT_VERIFY', 'CGI.SSL.Client.Verify'),
+    ('SSL_SERVER_M_VERSION', 'CGI.SSL.Server.M.Version'),
+    ('SSL_SERVER_M_SERIAL', 'CGI.SSL.Server.M.Serial'),
+    ('SSL_SERVER_S_DN', 'CGI.SSL.Server.S.DN'),
+    ('SSL_SERVER_S_DN_x509', 'CGI.SSL.Server.S.DN.x509'),
+    ('SSL_SERVER_S_DN_CN', 'CGI.SSL.Server.S.DN.CN'),
+    ('SSL_SERVER_S_DN_EMAIL', 'CGI.SSL.Server.S.DN.Email'),
+    ('SSL_SERVER_S_DN_O', 'CGI.SSL.Server.S.DN.O'),
+    ('SSL_SERVER_S_DN_OU', 'CGI.SSL.Server.S.DN.OU'),
+    ('SSL_SERVER_S_DN_C', 'CGI.SSL.Server.S.DN.C'),
+    ('SSL_SERVER_S_DN_SP', 'CGI.SSL.Server.S.DN.SP'),
+    ('SSL_SERVER_S_DN_L', 'CGI.SSL.Server.S.DN.L'),
+    ('SSL_SERVER_I_DN', 'CGI.SSL.Server.I.DN'),
+    ('SSL_SERVER_I_DN_x509', 'CGI.SSL.Server.I.DN.x509'),
+    ('SSL_SERVER_I_DN_CN', 'CGI.SSL.Server.I.DN.CN'),
+    ('SSL_SERVER_I_DN_EMAIL', 'CGI.SSL.Server.I.DN.Email'),
+    ('SSL_SERVER_I_DN_O', 'CGI.SSL.Server.I.DN.O'),
+    ('SSL_SERVER_I_DN_OU', 'CGI.SSL.Server.I.DN.OU'),
+    ('SSL_SERVER_I_DN_C', 'CGI.SSL.Server.I.DN.C'),
+    ('SSL_SERVER_I_DN_SP', 'CGI.SSL.Server.I.DN.SP'),
+    ('SSL_SERVER_I_DN_L', 'CGI.SSL.Server.I.DN.L'),
+    ('SSL_SERVER_V_START', 'CGI.SSL.Server.V.Start'),
+    ('SSL_SERVER_V_END', 'CGI.SSL.Server.V.End'),
+    ('SSL_SERVER_A_SIG', 'CGI.SSL.Server.A.SIG'),
+    ('SSL_SERVER_A_KEY', 'CGI.SSL.Server.A.KEY'),
+    ('SSL_SERVER_CERT', 'CGI.SSL.Server.CERT'),
     # SSL Vars mapped from others
     # if we're running under mod_ssl w/ +CompatEnvVars, we set these twice...
-    transfer_to_hdf('SSL_PROTOCOL_VERSION', 'CGI.SSL.Protocol')
-    transfer_to_hdf('SSLEAY_VERSION', 'CGI.SSL.Version.Library')
-    transfer_to_hdf('HTTPS_CIPHER', 'CGI.SSL.Cipher')
-    transfer_to_hdf('HTTPS_EXPORT', 'CGI.SSL.Cipher.Export')
-    transfer_to_hdf('HTTPS_SECRETKEYSIZE', 'CGI.SSL.Cipher.UseKeySize')
-    transfer_to_hdf('HTTPS_KEYSIZE', 'CGI.SSL.Cipher.AlgKeySize')
-    transfer_to_hdf('SSL_SERVER_KEY_SIZE', 'CGI.SSL.Cipher.AlgKeySize')
-    transfer_to_hdf('SSL_SERVER_CERTIFICATE', 'CGI.SSL.Server.CERT')
-    transfer_to_hdf('SSL_SERVER_CERT_START', 'CGI.SSL.Server.V.Start')
-    transfer_to_hdf('SSL_SERVER_CERT_END', 'CGI.SSL.Server.V.End')
-    transfer_to_hdf('SSL_SERVER_CERT_SERIAL', 'CGI.SSL.Server.M.Serial')
-    transfer_to_hdf('SSL_SERVER_SIGNATURE_ALGORITHM', 'CGI.SSL.Server.A.SIG')
-    transfer_to_hdf('SSL_SERVER_DN', 'CGI.SSL.Server.S.DN')
-    transfer_to_hdf('SSL_SERVER_CN', 'CGI.SSL.Server.S.DN.CN')
-    transfer_to_hdf('SSL_SERVER_EMAIL', 'CGI.SSL.Server.S.DN.Email')
-    transfer_to_hdf('SSL_SERVER_O', 'CGI.SSL.Server.S.DN.O')
-    transfer_to_hdf('SSL_SERVER_OU', 'CGI.SSL.Server.S.DN.OU')
-    transfer_to_hdf('SSL_SERVER_C', 'CGI.SSL.Server.S.DN.C')
-    transfer_to_hdf('SSL_SERVER_SP', 'CGI.SSL.Server.S.DN.SP')
-    transfer_to_hdf('SSL_SERVER_L', 'CGI.SSL.Server.S.DN.L')
-    transfer_to_hdf('SSL_SERVER_IDN', 'CGI.SSL.Server.I.DN')
-    transfer_to_hdf('SSL_SERVER_ICN', 'CGI.SSL.Server.I.DN.CN')
-    transfer_to_hdf('SSL_SERVER_IEMAIL', 'CGI.SSL.Server.I.DN.Email')
-    transfer_to_hdf('SSL_SERVER_IO', 'CGI.SSL.Server.I.DN.O')
-    transfer_to_hdf('SSL_SERVER_IOU', 'CGI.SSL.Server.I.DN.OU')
-    transfer_to_hdf('SSL_SERVER_IC', 'CGI.SSL.Server.I.DN.C')
-    transfer_to_hdf('SSL_SERVER_ISP', 'CGI.SSL.Server.I.DN.SP')
-    transfer_to_hdf('SSL_SERVER_IL', 'CGI.SSL.Server.I.DN.L')
-    transfer_to_hdf('SSL_CLIENT_CERTIFICATE', 'CGI.SSL.Client.CERT')
-    transfer_to_hdf('SSL_CLIENT_CERT_START', 'CGI.SSL.Client.V.Start')
-    transfer_to_hdf('SSL_CLIENT_CERT_END', 'CGI.SSL.Client.V.End')
-    transfer_to_hdf('SSL_CLIENT_CERT_SERIAL', 'CGI.SSL.Client.M.Serial')
-    transfer_to_hdf('SSL_CLIENT_SIGNATURE_ALGORITHM', 'CGI.SSL.Client.A.SIG')
-    transfer_to_hdf('SSL_CLIENT_DN', 'CGI.SSL.Client.S.DN')
-    transfer_to_hdf('SSL_CLIENT_CN', 'CGI.SSL.Client.S.DN.CN')
-    transfer_to_hdf('SSL_CLIENT_EMAIL', 'CGI.SSL.Client.S.DN.Email')
-    transfer_to_hdf('SSL_CLIENT_O', 'CGI.SSL.Client.S.DN.O')
-    transfer_to_hdf('SSL_CLIENT_OU', 'CGI.SSL.Client.S.DN.OU')
-    transfer_to_hdf('SSL_CLIENT_C', 'CGI.SSL.Client.S.DN.C')
-    transfer_to_hdf('SSL_CLIENT_SP', 'CGI.SSL.Client.S.DN.SP')
-    transfer_to_hdf('SSL_CLIENT_L', 'CGI.SSL.Client.S.DN.L')
-    transfer_to_hdf('SSL_CLIENT_IDN', 'CGI.SSL.Client.I.DN')
-    transfer_to_hdf('SSL_CLIENT_ICN', 'CGI.SSL.Client.I.DN.CN')
-    transfer_to_hdf('SSL_CLIENT_IEMAIL', 'CGI.SSL.Client.I.DN.Email')
-    transfer_to_hdf('SSL_CLIENT_IO', 'CGI.SSL.Client.I.DN.O')
-    transfer_to_hdf('SSL_CLIENT_IOU', 'CGI.SSL.Client.I.DN.OU')
-    transfer_to_hdf('SSL_CLIENT_IC', 'CGI.SSL.Client.I.DN.C')
-    transfer_to_hdf('SSL_CLIENT_ISP', 'CGI.SSL.Client.I.DN.SP')
-    transfer_to_hdf('SSL_CLIENT_IL', 'CGI.SSL.Client.I.DN.L')
-    transfer_to_hdf('SSL_EXPORT', 'CGI.SSL.Cipher.Export')
-    transfer_to_hdf('SSL_KEYSIZE', 'CGI.SSL.Cipher.AlgKeySize')
-    transfer_to_hdf('SSL_SECKEYSIZE', 'CGI.SSL.Cipher.UseKeySize')
-    transfer_to_hdf('SSL_SSLEAY_VERSION', 'CGI.SSL.Version.Library')
-    transfer_to_hdf('SSL_STRONG_CRYPTO', 'CGI.SSL.Strong.Crypto')
-    transfer_to_hdf('SSL_SERVER_KEY_EXP', 'CGI.SSL.Server.Key.Exp')
-    transfer_to_hdf('SSL_SERVER_KEY_ALGORITHM', 'CGI.SSL.Server.Key.Algorithm')
-    transfer_to_hdf('SSL_SERVER_KEY_SIZE', 'CGI.SSL.Server.Key.Size')
-    transfer_to_hdf('SSL_SERVER_SESSIONDIR', 'CGI.SSL.Server.SessionDir')
-    transfer_to_hdf('SSL_SERVER_CERTIFICATELOGDIR', 'CGI.SSL.Server.CertificateLogDir')
-    transfer_to_hdf('SSL_SERVER_CERTFILE', 'CGI.SSL.Server.CertFile')
-    transfer_to_hdf('SSL_SERVER_KEYFILE', 'CGI.SSL.Server.KeyFile')
-    transfer_to_hdf('SSL_SERVER_KEYFILETYPE', 'CGI.SSL.Server.KeyFileType')
-    transfer_to_hdf('SSL_CLIENT_KEY_EXP', 'CGI.SSL.Client.Key.Exp')
-    transfer_to_hdf('SSL_CLIENT_KEY_ALGORITHM', 'CGI.SSL.Client.Key.Algorithm')
-    transfer_to_hdf('SSL_CLIENT_KEY_SIZE', 'CGI.SSL.Client.Key.Size')
+    ('SSL_PROTOCOL_VERSION', 'CGI.SSL.Protocol'),
+    ('SSLEAY_VERSION', 'CGI.SSL.Version.Library'),
+    ('HTTPS_CIPHER', 'CGI.SSL.Cipher'),
+    ('HTTPS_EXPORT', 'CGI.SSL.Cipher.Export'),
+    ('HTTPS_SECRETKEYSIZE', 'CGI.SSL.Cipher.UseKeySize'),
+    ('HTTPS_KEYSIZE', 'CGI.SSL.Cipher.AlgKeySize'),
+    ('SSL_SERVER_KEY_SIZE', 'CGI.SSL.Cipher.AlgKeySize'),
+    ('SSL_SERVER_CERTIFICATE', 'CGI.SSL.Server.CERT'),
+    ('SSL_SERVER_CERT_START', 'CGI.SSL.Server.V.Start'),
+    ('SSL_SERVER_CERT_END', 'CGI.SSL.Server.V.End'),
+    ('SSL_SERVER_CERT_SERIAL', 'CGI.SSL.Server.M.Serial'),
+    ('SSL_SERVER_SIGNATURE_ALGORITHM', 'CGI.SSL.Server.A.SIG'),
+    ('SSL_SERVER_DN', 'CGI.SSL.Server.S.DN'),
+    ('SSL_SERVER_CN', 'CGI.SSL.Server.S.DN.CN'),
+    ('SSL_SERVER_EMAIL', 'CGI.SSL.Server.S.DN.Email'),
+    ('SSL_SERVER_O', 'CGI.SSL.Server.S.DN.O'),
+    ('SSL_SERVER_OU', 'CGI.SSL.Server.S.DN.OU'),
+    ('SSL_SERVER_C', 'CGI.SSL.Server.S.DN.C'),
+    ('SSL_SERVER_SP', 'CGI.SSL.Server.S.DN.SP'),
+    ('SSL_SERVER_L', 'CGI.SSL.Server.S.DN.L'),
+    ('SSL_SERVER_IDN', 'CGI.SSL.Server.I.DN'),
+    ('SSL_SERVER_ICN', 'CGI.SSL.Server.I.DN.CN'),
+    ('SSL_SERVER_IEMAIL', 'CGI.SSL.Server.I.DN.Email'),
+    ('SSL_SERVER_IO', 'CGI.SSL.Server.I.DN.O'),
+    ('SSL_SERVER_IOU', 'CGI.SSL.Server.I.DN.OU'),
+    ('SSL_SERVER_IC', 'CGI.SSL.Server.I.DN.C'),
+    ('SSL_SERVER_ISP', 'CGI.SSL.Server.I.DN.SP'),
+    ('SSL_SERVER_IL', 'CGI.SSL.Server.I.DN.L'),
+    ('SSL_CLIENT_CERTIFICATE', 'CGI.SSL.Client.CERT'),
+    ('SSL_CLIENT_CERT_START', 'CGI.SSL.Client.V.Start'),
+    ('SSL_CLIENT_CERT_END', 'CGI.SSL.Client.V.End'),
+    ('SSL_CLIENT_CERT_SERIAL', 'CGI.SSL.Client.M.Serial'),
+    ('SSL_CLIENT_SIGNATURE_ALGORITHM', 'CGI.SSL.Client.A.SIG'),
+    ('SSL_CLIENT_DN', 'CGI.SSL.Client.S.DN'),
+    ('SSL_CLIENT_CN', 'CGI.SSL.Client.S.DN.CN'),
+    ('SSL_CLIENT_EMAIL', 'CGI.SSL.Client.S.DN.Email'),
+    ('SSL_CLIENT_O', 'CGI.SSL.Client.S.DN.O'),
+    ('SSL_CLIENT_OU', 'CGI.SSL.Client.S.DN.OU'),
+    ('SSL_CLIENT_C', 'CGI.SSL.Client.S.DN.C'),
+    ('SSL_CLIENT_SP', 'CGI.SSL.Client.S.DN.SP'),
+    ('SSL_CLIENT_L', 'CGI.SSL.Client.S.DN.L'),
+    ('SSL_CLIENT_IDN', 'CGI.SSL.Client.I.DN'),
+    ('SSL_CLIENT_ICN', 'CGI.SSL.Client.I.DN.CN'),
+    ('SSL_CLIENT_IEMAIL', 'CGI.SSL.Client.I.DN.Email'),
+    ('SSL_CLIENT_IO', 'CGI.SSL.Client.I.DN.O'),
+    ('SSL_CLIENT_IOU', 'CGI.SSL.Client.I.DN.OU'),
+    ('SSL_CLIENT_IC', 'CGI.SSL.Client.I.DN.C'),
+    ('SSL_CLIENT_ISP', 'CGI.SSL.Client.I.DN.SP'),
+    ('SSL_CLIENT_IL', 'CGI.SSL.Client.I.DN.L'),
+    ('SSL_EXPORT', 'CGI.SSL.Cipher.Export'),
+    ('SSL_KEYSIZE', 'CGI.SSL.Cipher.AlgKeySize'),
+    ('SSL_SECKEYSIZE', 'CGI.SSL.Cipher.UseKeySize'),
+    ('SSL_SSLEAY_VERSION', 'CGI.SSL.Version.Library'),
+    ('SSL_STRONG_CRYPTO', 'CGI.SSL.Strong.Crypto'),
+    ('SSL_SERVER_KEY_EXP', 'CGI.SSL.Server.Key.Exp'),
+    ('SSL_SERVER_KEY_ALGORITHM', 'CGI.SSL.Server.Key.Algorithm'),
+    ('SSL_SERVER_KEY_SIZE', 'CGI.SSL.Server.Key.Size'),
+    ('SSL_SERVER_SESSIONDIR', 'CGI.SSL.Server.SessionDir'),
+    ('SSL_SERVER_CERTIFICATELOGDIR', 'CGI.SSL.Server.CertificateLogDir'),
+    ('SSL_SERVER_CERTFILE', 'CGI.SSL.Server.CertFile'),
+    ('SSL_SERVER_KEYFILE', 'CGI.SSL.Server.KeyFile'),
+    ('SSL_SERVER_KEYFILETYPE', 'CGI.SSL.Server.KeyFileType'),
+    ('SSL_CLIENT_KEY_EXP', 'CGI.SSL.Client.Key.Exp'),
+    ('SSL_CLIENT_KEY_ALGORITHM', 'CGI.SSL.Client.Key.Algorithm'),
+    ('SSL_CLIENT_KEY_SIZE', 'CGI.SSL.Client.Key.Size'),
     # HTTP vars
-    transfer_to_hdf('HTTP_ACCEPT', 'HTTP.Accept')
-    transfer_to_hdf('HTTP_ACCEPT_CHARSET', 'HTTP.AcceptCharset')
-    transfer_to_hdf('HTTP_ACCEPT_ENCODING', 'HTTP.AcceptEncoding')
-    transfer_to_hdf('HTTP_ACCEPT_LANGUAGE', 'HTTP.AcceptLanguage')
-    transfer_to_hdf('HTTP_COOKIE', 'HTTP.Cookie')
-    transfer_to_hdf('HTTP_HOST', 'HTTP.Host')
-    transfer_to_hdf('HTTP_USER_AGENT', 'HTTP.UserAgent')
-    transfer_to_hdf('HTTP_IF_MODIFIED_SINCE', 'HTTP.IfModifiedSince')
-    transfer_to_hdf('HTTP_REFERER', 'HTTP.Referer')
-    transfer_to_hdf('HTTP_VIA', 'HTTP.Via')
+    ('HTTP_ACCEPT', 'HTTP.Accept'),
+    ('HTTP_ACCEPT_CHARSET', 'HTTP.AcceptCharset'),
+    ('HTTP_ACCEPT_ENCODING', 'HTTP.AcceptEncoding'),
+    ('HTTP_ACCEPT_LANGUAGE', 'HTTP.AcceptLanguage'),
+    ('HTTP_COOKIE', 'HTTP.Cookie'),
+    ('HTTP_HOST', 'HTTP.Host'),
+    ('HTTP_USER_AGENT', 'HTTP.UserAgent'),
+    ('HTTP_IF_MODIFIED_SINCE', 'HTTP.IfModifiedSince'),
+    ('HTTP_REFERER', 'HTTP.Referer'),
+    ('HTTP_VIA', 'HTTP.Via'),
     # SOAP
-    transfer_to_hdf('HTTP_SOAPACTION', 'HTTP.Soap.Action')
+    ('HTTP_SOAPACTION', 'HTTP.Soap.Action'),
+)
+
+# environment variable -> [(position in cgi_vars, HDF subtree, HDF name), ...]
+# Some variables go in two places, and some HDF names are set from two
+# variables, in which case the later one in cgi_vars wins, as in the CGI kit.
+_cgi_var_index = {}
+for position, (cgi_name, hdf_name) in enumerate(cgi_vars):
+    _cgi_var_index.setdefault(cgi_name, []).append((position, hdf_name.split('.', 1)[0], hdf_name))
+del position, cgi_name, hdf_name
+
+def load_hdf_cgi_vars(req, hdf, subtrees=('CGI', 'HTTP')):
+    '''Load request data into the HDF as is done by the CGI kit.
+
+    This method loads the HTTP headers (into ``HTTP``) and CGI environment
+    variables (into ``CGI``), or only the ones in ``subtrees``. Only the
+    variables actually present in the environment are looked at.'''
+    environ = req.environ
+    transfers = []
+    for cgi_name in environ:
+        if cgi_name in _cgi_var_index:
+            transfers.extend(_cgi_var_index[cgi_name])
+    transfers.sort()
+    for position, subtree, hdf_name in transfers:
+        if subtree in subtrees:
+            hdf.setValue(hdf_name, str(environ[cgi_vars[position][0]]))
 
 def load_hdf_cookie_vars(req, hdf):
     '''Copies data from the cookies into the HDF object.'''
@@ -309,35 +397,39 @@ def hdf_iterate(hdf, path = None):
             yield hdf
             hdf = hdf.next()
 
-def hdf_insert_value(hdf, dvalue, path, fmt=default_fmt):
+def hdf_insert_value(hdf, dvalue, path, fmt=default_fmt, cache=None):
     '''Insert a value as a string'''
     if path:
         path = path.rstrip('.')
     if isinstance(dvalue, list):
-        hdf_insert_list(hdf, dvalue, path, fmt)
+        hdf_insert_list(hdf, dvalue, path, fmt, cache)
     elif isinstance(dvalue, dict):
-        hdf_insert_dict(hdf, dvalue, path, fmt)
+        hdf_insert_dict(hdf, dvalue, path, fmt, cache)
     elif isinstance(dvalue, Entity):
-        hdf_insert_model(hdf, dvalue, path, fmt)
+        hdf_insert_model(hdf, dvalue, path, fmt, cache)
     elif dvalue is not None:
         hdf.setValue(path, fmt(path, dvalue))
 
-def hdf_insert_list(hdf, dlist, path='', fmt=default_fmt):
+def hdf_insert_list(hdf, dlist, path='', fmt=default_fmt, cache=None):
     '''Insert a list of values as children of an HDF node'''
     n = 0
     for elem in dlist:
-        if elem != dlist:
-            hdf_insert_value(hdf, elem, '%s.%d' % (path, n), fmt)
+        # an identity check, because comparing each element to the whole list is slow
+        if elem is not dlist:
+            hdf_insert_value(hdf, elem, '%s.%d' % (path, n), fmt, cache)
             n += 1
 
-def hdf_insert_dict(hdf, ddict, path='', fmt=default_fmt):
+def hdf_insert_dict(hdf, ddict, path='', fmt=default_fmt, cache=None):
     '''Insert a dictionary of values as children of an HDF node'''
-    for key in ddict.iterkeys():
-        if ddict[key] != ddict:
-            key_path = ('%s.%s' % (path, str(key))).lstrip('.')
-            hdf_insert_value(hdf, ddict[key], key_path, fmt)
+    if path:
+        path += '.'
+    for key, value in ddict.iteritems():
+        if value is not ddict:
+            hdf_insert_value(hdf, value, path + str(key), fmt, cache)
 
-def hdf_insert_model(hdf, dmodel, path='', fmt=default_fmt):
+def hdf_insert_model(hdf, dmodel, path='', fmt=default_fmt, cache=None):
+    '''Insert the columns of a model object, as given by :func:`model_to_dict`,
+    as children of an HDF node'''
     # We have to put in some irritating special cases
     # Use class name comparison to avoid loading the publish module if it's not really needed
     # TODO: find a way around this
@@ -347,4 +439,83 @@ def hdf_insert_model(hdf, dmodel, path='', fmt=default_fmt):
             deep = {'user': {}}
         elif dmodel.__class__.__name__ == 'Comment':
             deep = {'user': {}}
-    hdf_insert_dict(hdf, dmodel.to_dict(deep=deep), path, fmt)
+    if cache is None:
+        data = model_to_dict(dmodel, deep)
+    else:
+        data = cache.get(dmodel, deep)
+    hdf_insert_dict(hdf, data, path, fmt, cache)
+
+def _deep_key(deep):
+    # a hashable version of the nested dicts taken by Entity.to_dict()
+    return tuple(sorted((name, _deep_key(rdeep)) for name, rdeep in deep.iteritems()))
+
+_model_plans = {}
+
+def model_plan(cls, deep=None, exclude=()):
+    '''Returns a plan for converting instances of the model class ``cls`` to dicts
+    the way ``to_dict(deep, exclude)`` does, or ``None`` if the class has its own
+    ``to_dict()``.
+
+    The plan is a tuple of the names of the column properties to include and a tuple of
+    ``(relation name, deep, exclude)`` for the related objects to include. It's
+    worked out once for each class and set of arguments, instead of every time
+    an object is converted.'''
+    deep = deep or {}
+    key = (cls, _deep_key(deep), tuple(exclude))
+    try:
+        return _model_plans[key]
+    except KeyError:
+        pass
+    if cls.to_dict.im_func is not Entity.to_dict.im_func:
+        plan = None
+    else:
+        columns = tuple(prop.key for prop in cls.mapper.iterate_properties if isinstance(prop, ColumnProperty) and prop.key not in exclude)
+        relations = []
+        for rname, rdeep in deep.iteritems():
+            # to_dict() leaves out the columns which point back to the object
+            rexclude = tuple(col.name for col in cls.mapper.get_property(rname).remote_side)
+            relations.append((rname, rdeep, rexclude))
+        plan = (columns, tuple(relations))
+    _model_plans[key] = plan
+    return plan
+
+def model_to_dict(dmodel, deep=None, exclude=()):
+    '''Does the same thing as ``dmodel.to_dict(deep, exclude)``, using the plan
+    from :func:`model_plan`.'''
+    plan = model_plan(dmodel.__class__, deep, exclude)
+    if plan is None:
+        return dmodel.to_dict(deep or {}, list(exclude))
+    columns, relations = plan
+    data = dict((key, getattr(dmodel, key)) for key in columns)
+    for rname, rdeep, rexclude in relations:
+        related = getattr(dmodel, rname)
+        if related is None:
+            data[rname] = None
+        elif isinstance(related, list):
+            data[rname] = [model_to_dict(obj, rdeep, rexclude) for obj in related]
+        else:
+            data[rname] = model_to_dict(related, rdeep, rexclude)
+    return data
+
+class ModelDictCache(object):
+    '''A bounded cache of the dicts made from model objects by :func:`model_to_dict`.
+
+    An object is identified by its class, its primary key, and the value of its
+    ``version_column``, so a cached dict is only reused as long as the object
+    has the same version. This only works if the version is changed every time
+    the object, or any related object that goes in the dict, is changed. Objects
+    without a version aren't cached. At most ``capacity`` dicts are kept.'''
+    def __init__(self, capacity=1000, version_column='version'):
+        self.dicts = LRUCache(capacity)
+        self.version_column = version_column
+
+    def get(self, dmodel, deep=None):
+        '''Returns the dict made from ``dmodel``, which mustn't be modified.'''
+        version = getattr(dmodel, self.version_column, None)
+        if version is None:
+            return model_to_dict(dmodel, deep)
+        key = (dmodel.__class__, tuple(dmodel.mapper.primary_key_from_instance(dmodel)), version, _deep_key(deep or {}))
+        data = self.dicts.get(key)
+        if data is None:
+            data = self.dicts[key] = model_to_dict(dmodel, deep)
+        return data
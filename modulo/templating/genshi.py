@@ -2,34 +2,56 @@
 
 from __future__ import absolute_import
 
-from genshi.template import TemplateLoader
+import threading
+from genshi.template import Context, TemplateLoader
 from modulo.actions import Action
 from modulo.actions.standard import FileResource
+from modulo.templating import TemplateContext, set_output
 from os.path import isfile, join
 
-# Used for loading templates specified by filename when no
-# custom loader is provided
-_loader_instance = None
+_loaders = {}
+_loaders_lock = threading.Lock()
 
-def _loader():
-    if _loader_instance is None:
-        _loader_instance = TemplateLoader(auto_reload=True)
-    return _loader_instance
+def shared_loader(search_path=None, max_cache_size=25, auto_reload=True):
+    '''Returns a Genshi ``TemplateLoader`` which loads templates from ``search_path``.
+
+    All calls with the same arguments return the same loader, so all the actions
+    that use templates from the same place share one set of parsed templates.
+    ``max_cache_size`` is the number of parsed templates the loader keeps, and
+    ``auto_reload`` is whether it checks the template files for changes, which
+    you can turn off in production. With no ``search_path``, the loader can only
+    load templates given by their full filenames.'''
+    if search_path is None:
+        key_path = ()
+    elif isinstance(search_path, basestring):
+        key_path = (search_path,)
+    else:
+        key_path = tuple(search_path)
+    key = (key_path, max_cache_size, auto_reload)
+    with _loaders_lock:
+        try:
+            return _loaders[key]
+        except KeyError:
+            loader = _loaders[key] = TemplateLoader(list(key_path), auto_reload=auto_reload, max_cache_size=max_cache_size)
+            return loader
 
 class GenshiFilesystemTemplate(FileResource):
+    '''Renders a Genshi template, producing a ``stream`` parameter for
+    :class:`GenshiFilter` and :class:`GenshiStreamRenderer`.
+
+    Templates are loaded with ``loader`` if it's given, or otherwise with the
+    :func:`shared_loader` for ``search_path``, to which ``max_cache_size`` and
+    ``auto_reload`` are passed on.'''
     namespace = '*'
     @classmethod
-    def derive(cls, filename=None, search_path=None, loader=None, **kwargs):
-        # Need to make sure the search_path parameter matches the loader's search path
-        if search_path is None and loader is None:
+    def derive(cls, filename=None, search_path=None, loader=None, max_cache_size=25, auto_reload=True, **kwargs):
+        if loader is None:
+            loader = shared_loader(search_path, max_cache_size, auto_reload)
+        if search_path is None and not loader.search_path:
             # Creating a single-template action
-            return super(GenshiFilesystemTemplate, cls).derive(filename=filename, **kwargs)
+            return super(GenshiFilesystemTemplate, cls).derive(filename=filename, loader=loader, **kwargs)
         else:
-            if loader is None:
-                if search_path is None:
-                    loader = _loader()
-                else:
-                    loader = TemplateLoader(search_path, auto_reload=True)
+            # Need to make sure the search_path parameter matches the loader's search path
             search_path = loader.search_path
             if filename is None:
                 # Creating a dynamically loading action
@@ -39,14 +61,17 @@ class GenshiFilesystemTemplate(FileResource):
                 return super(GenshiFilesystemTemplate, cls).derive(filename=filename, search_path=search_path, loader=loader, **kwargs)
 
     def generate(self, rsp, **kwargs):
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
+        context = TemplateContext.for_action(self, kwargs)
+        # Genshi looks names up in a stack of frames, so the layers can be used as they are
+        ctxt = Context()
+        for layer in reversed(context.layers):
+            ctxt.push(layer)
         try:
             loader = self.loader
         except AttributeError:
-            loader = _loader()
+            loader = shared_loader()
         template = loader.load(self.filename)
-        return {'stream': template.generate(**template_data)}
+        return {'stream': template.generate(ctxt)}
 
 class GenshiFilter(Action):
     @classmethod
@@ -57,8 +82,16 @@ class GenshiFilter(Action):
         return {'stream': stream.filter(self.filter)}
 
 class GenshiStreamRenderer(Action):
+    # set to True to send the page on as it's serialized
+    stream = False
     def generate(self, rsp, stream):
-        rsp.data = stream.render(getattr(self, 'mode', 'html'), doctype=getattr(self, 'doctype', 'html'))
+        mode = getattr(self, 'mode', 'html')
+        doctype = getattr(self, 'doctype', 'html')
+        if self.stream:
+            # serialize() produces the output bit by bit as the response is sent
+            set_output(rsp, stream.serialize(mode, doctype=doctype), True)
+        else:
+            rsp.data = stream.render(mode, doctype=doctype)
         del stream
         return {'stream': None}
 
@@ -2,11 +2,64 @@
 
 from __future__ import absolute_import
 
-from jinja2 import Environment, FileSystemLoader
+import sys
+import threading
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from modulo.actions import Action
 from modulo.actions.standard import FileResource
+from modulo.templating import TemplateContext, set_output
 from os.path import join
 
+_environments = {}
+_environments_lock = threading.Lock()
+
+def shared_environment(search_path, cache_size=50, auto_reload=True, bytecode_cache_dir=None):
+    '''Returns a Jinja ``Environment`` which loads templates from ``search_path``.
+
+    All calls with the same arguments return the same environment, so all the
+    actions that use templates from the same place share one set of compiled
+    templates. ``cache_size`` is the number of compiled templates the environment
+    keeps, and ``auto_reload`` is whether it checks the template files for changes.
+    If ``bytecode_cache_dir`` is given, compiled templates are also saved in that
+    directory, so that new processes can load them instead of compiling the
+    templates again.'''
+    if isinstance(search_path, basestring):
+        key_path = (search_path,)
+    else:
+        key_path = tuple(search_path)
+    key = (key_path, cache_size, auto_reload, bytecode_cache_dir)
+    with _environments_lock:
+        try:
+            return _environments[key]
+        except KeyError:
+            if bytecode_cache_dir is None:
+                bytecode_cache = None
+            else:
+                bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+            env = _environments[key] = Environment(
+                loader=FileSystemLoader(search_path),
+                cache_size=cache_size,
+                auto_reload=auto_reload,
+                bytecode_cache=bytecode_cache
+            )
+            return env
+
+def generate_template(template, context):
+    '''Does the same thing as ``template.generate()``, but takes a
+    :class:`~modulo.templating.TemplateContext` and uses it for the template's
+    variables as it is, instead of copying it into a new dict.'''
+    # a shared context uses the given mapping as its parent, so the template's
+    # globals have to be added as its lowest layer
+    jcontext = template.new_context(context.with_defaults(template.globals), shared=True)
+    try:
+        for event in template.root_render_func(jcontext):
+            yield event
+    except Exception:
+        exc_info = sys.exc_info()
+    else:
+        return
+    yield template.environment.handle_exception(exc_info, True)
+
 class JinjaEnvironment(Action):
     @classmethod
     def derive(cls, env=None, loader=None, bytecode_cache=None, **kwargs):
@@ -18,22 +71,27 @@ class JinjaEnvironment(Action):
 
 class JinjaTemplate(Action):
     namespace = '*'
+    # Jinja generates its output bit by bit, so it's streamed by default
+    stream = True
     def generate(self, rsp, env, **kwargs):
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
-        rsp.response = self.env.get_template(self.template_name).generate(template_data)
+        set_output(rsp, generate_template(env.get_template(self.template_name), TemplateContext.for_action(self, kwargs)), self.stream)
 
 class JinjaFilesystemTemplate(FileResource):
+    '''Renders a Jinja template found in ``search_path``.
+
+    The environment used to load the template comes from :func:`shared_environment`,
+    and the arguments ``cache_size``, ``auto_reload``, and ``bytecode_cache_dir``
+    are passed on to it.'''
     namespace = '*'
+    stream = True
     @classmethod
-    def derive(cls, search_path, **kwargs):
-        return super(JinjaFilesystemTemplate, cls).derive(env=Environment(loader=FileSystemLoader(search_path)), search_path=search_path, **kwargs)
+    def derive(cls, search_path, cache_size=50, auto_reload=True, bytecode_cache_dir=None, **kwargs):
+        env = shared_environment(search_path, cache_size, auto_reload, bytecode_cache_dir)
+        return super(JinjaFilesystemTemplate, cls).derive(env=env, search_path=search_path, **kwargs)
 
     def generate(self, rsp, **kwargs):
         # Because Jinja handles the search path internally, we have to strip it off here
         template = self.filename
         if template.startswith(self.search_path):
             template = template[len(self.search_path):].lstrip('/')
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
-        rsp.response = self.env.get_template(template).generate(template_data)
+        set_output(rsp, generate_template(self.env.get_template(template), TemplateContext.for_action(self, kwargs)), self.stream)
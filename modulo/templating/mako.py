@@ -5,17 +5,34 @@ from __future__ import absolute_import
 from mako.template import Template
 from modulo.actions import Action
 from modulo.actions.standard import FileResource
+from modulo.templating import TemplateCache, TemplateContext, set_output
+
+# Compiling a Mako template is much slower than rendering it, so the compiled
+# templates are shared by all the Mako actions. Set a different TemplateCache as
+# the cache attribute of an action class (or pass it to derive()) to change that.
+template_cache = TemplateCache()
 
 class MakoStringTemplate(Action):
     namespace = '*'
+    cache = template_cache
     def generate(self, rsp, **kwargs):
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
-        rsp.response = Template(self.template).render_unicode(**template_data)
+        context = TemplateContext.for_action(self, kwargs)
+        set_output(rsp, self.cache.from_string(self.template, Template).render_unicode(**context.copy()))
 
 class MakoFilesystemTemplate(FileResource):
+    '''Renders a Mako template file.
+
+    If ``module_directory`` is set, Mako will also save the Python modules it
+    compiles templates to in that directory, and reuse them in other processes
+    (or after the compiled template has been dropped from the cache) as long
+    as the template file hasn't changed.'''
     namespace = '*'
+    cache = template_cache
+    module_directory = None
     def generate(self, rsp, **kwargs):
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
-        rsp.data = Template(filename=self.filename).render_unicode(**template_data)
+        context = TemplateContext.for_action(self, kwargs)
+        set_output(rsp, self.cache.from_file(self.filename, self.compile).render_unicode(**context.copy()))
+
+    @classmethod
+    def compile(cls, filename):
+        return Template(filename=filename, module_directory=cls.module_directory)
@@ -2,22 +2,31 @@
 
 from modulo.actions import Action
 from modulo.actions.standard import FileResource
+from modulo.templating import TemplateCache, TemplateContext, set_output
 from werkzeug.templates import Template
 
+# Parsed templates shared by the mini template actions. Template files are only
+# checked for changes if it's been check_interval seconds since the last check,
+# so set template_cache.check_interval to suit (0 checks on every request).
+template_cache = TemplateCache(check_interval=2)
+
 class MiniTemplate(FileResource):
     namespace = '*'
+    cache = template_cache
     def generate(self, rsp, **kwargs):
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
-        rsp.data = Template.from_file(self.filename).render(template_data)
+        context = TemplateContext.for_action(self, kwargs)
+        # render() merges its arguments into a namespace of its own
+        template = self.cache.from_file(self.filename, Template.from_file)
+        set_output(rsp, template.render(context.environ, **context.params))
         
 class MiniStringTemplate(Action):
     namespace = '*'
     @classmethod
     def derive(cls, template, **kwargs):
+        # parse the template now rather than on every request
+        if isinstance(template, basestring):
+            template = template_cache.from_string(template, Template)
         return super(MiniStringTemplate, cls).derive(template=template, **kwargs)
     def generate(self, rsp, **kwargs):
-        template_data = self.req.environ.copy()
-        template_data.update(kwargs)
-        rsp.data = Template(self.template).render(template_data)
-        
\ No newline at end of file
+        context = TemplateContext.for_action(self, kwargs)
+        set_output(rsp, self.template.render(context.environ, **context.params))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+'''Benchmarks for the action dispatch engine.
+
+This builds synthetic action trees of various shapes and sizes, wraps each one
+in a :func:`~modulo.WSGIModuloApp`, and calls the application directly with WSGI
+environments made up in the same process, so that no time is spent on the
+network or in a server. For each tree it reports the number of requests per
+second, latency percentiles, and the number of objects each request leaves
+behind for the garbage collector, from the fastest of ``--repeat`` runs. Run it
+with ``--help`` to see the options.
+
+The trees are:
+
+``uri``
+    an ``any_of`` with ``width`` branches, each selected by a :class:`URIFilter`
+``prefix``
+    the same, using :class:`URIPrefixFilter`
+``map``
+    a :class:`WerkzeugMapFilter` with ``width`` rules
+``params``
+    an ``all_of`` chain of ``width`` actions which each add parameters
+    to the parameter set, followed by one that uses all of them
+``nested``
+    ``any_of``, ``all_of`` and ``opt`` nested ``depth`` levels deep,
+    ``width`` branches wide, routed by :class:`URIFilter`
+
+Each tree can be run through the plain action tree, a compiled
+:class:`~modulo.actions.dispatch.DispatchPlan`, or a
+:class:`~modulo.actions.dispatch.RoutingCache`, so that the routing strategies
+can be compared.'''
+
+import gc
+import json
+import logging
+import sys
+from optparse import OptionParser
+from os.path import abspath, dirname
+
+basedir = dirname(dirname(dirname(abspath(__file__))))
+if basedir not in sys.path:
+    sys.path.append(basedir)
+
+from modulo import WSGIModuloApp, all_of, any_of, opt, timer
+from modulo.actions import Action
+from modulo.actions.filters import URIFilter, URIPrefixFilter, WerkzeugMapFilter
+from werkzeug.routing import Map, Rule
+from werkzeug.test import create_environ
+
+class Body(Action):
+    '''Sets the response body.'''
+    def generate(self, rsp, body='ok'):
+        rsp.data = body
+
+class Emit(Action):
+    '''Adds the contents of the class variable ``values`` to the parameter set.'''
+    values = {}
+    def generate(self, rsp):
+        return self.values
+
+class Consume(Action):
+    '''Takes all the parameters in the parameter set.'''
+    def generate(self, rsp, **kwargs):
+        return {'body': str(len(kwargs))}
+
+def uri_tree(width, depth):
+    tree = any_of(*[URIFilter(r'/section%d/(?P<item>\d+)$' % i) & Body for i in range(width)])
+    return tree, ['/section%d/42' % i for i in (0, width // 2, width - 1)] + ['/missing']
+
+def prefix_tree(width, depth):
+    tree = any_of(*[URIPrefixFilter('/section%d' % i) & Body for i in range(width)])
+    return tree, ['/section%d/42' % i for i in (0, width // 2, width - 1)] + ['/missing']
+
+def map_tree(width, depth):
+    routing_map = Map([Rule('/section%d/<int:item>' % i, endpoint='section%d' % i) for i in range(width)])
+    tree = WerkzeugMapFilter(routing_map=routing_map, action_map=dict(('section%d' % i, Body) for i in range(width)))
+    return tree, ['/section%d/42' % i for i in (0, width // 2, width - 1)] + ['/missing']
+
+def params_tree(width, depth):
+    chain = [Emit(values=dict(('p%d_%d' % (i, j), j) for j in range(10))) for i in range(width)]
+    tree = all_of(*(chain + [Consume, Body]))
+    return tree, ['/']
+
+def nested_tree(width, depth):
+    def level(d, path):
+        if d == depth:
+            return Body
+        return any_of(*[
+            all_of(URIFilter(r'%s/%d(?:/|$)' % (path, i)), opt(Emit(values={'level%d' % d: i})), level(d + 1, '%s/%d' % (path, i)))
+            for i in range(width)
+        ])
+    paths = ['/' + '/'.join([str(i)] * depth) for i in (0, width // 2, width - 1)] + ['/missing']
+    return level(0, ''), paths
+
+trees = {
+    'uri': uri_tree,
+    'prefix': prefix_tree,
+    'map': map_tree,
+    'params': params_tree,
+    'nested': nested_tree,
+}
+
+modes = {
+    'tree': {},
+    'compiled': {'compiled': True},
+    'cached': {'routing_cache_size': 1000},
+}
+
+def percentile(sorted_values, p):
+    '''Returns the ``p``th percentile (nearest rank) of a sorted list.'''
+    return sorted_values[max(0, (len(sorted_values) * p + 99) // 100 - 1)]
+
+def run(app, paths, requests, warmup=100):
+    '''Sends ``requests`` requests for the given paths, in rotation, to the WSGI
+    application ``app``, and returns a dict of results.'''
+    environs = [create_environ(path) for path in paths]
+    def start_response(status, headers, exc_info=None):
+        pass
+    def call(environ):
+        # each request gets its own copy, as it would from a real server
+        for chunk in app(dict(environ), start_response):
+            pass
+    for i in xrange(warmup):
+        call(environs[i % len(environs)])
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        latencies = []
+        t0 = timer()
+        for i in xrange(requests):
+            t = timer()
+            call(environs[i % len(environs)])
+            latencies.append(timer() - t)
+        elapsed = timer() - t0
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    latencies.sort()
+    return {
+        'requests': requests,
+        'rps': requests / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'gc_objects': float(after - before) / requests,
+    }
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [tree ...]', description='Benchmark the Modulo action dispatch engine. Trees: ' + ', '.join(sorted(trees)))
+    parser.add_option('-n', '--requests', type='int', default=2000, help='number of requests to time for each tree (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='number of times to time each tree, keeping the fastest run (default %default)')
+    parser.add_option('-w', '--width', type='int', action='append', help='number of branches at each level (may be repeated; default 10)')
+    parser.add_option('-d', '--depth', type='int', action='append', help='levels of nesting for the nested tree (may be repeated; default 3)')
+    parser.add_option('-m', '--mode', action='append', choices=sorted(modes), help='dispatch mode: ' + ', '.join(sorted(modes)) + ' (may be repeated; default all)')
+    parser.add_option('--json', action='store_true', help='print the results as JSON instead of a table')
+    options, args = parser.parse_args(argv)
+    for name in args:
+        if name not in trees:
+            parser.error('unknown tree: ' + name)
+
+    # the debug messages would swamp the output, and the time taken to log them
+    # would swamp the time being measured
+    logging.getLogger('modulo').setLevel(logging.WARNING)
+
+    results = []
+    for name in args or sorted(trees):
+        for width in options.width or [10]:
+            for depth in (options.depth or [3]) if name == 'nested' else [None]:
+                tree, paths = trees[name](width, depth)
+                for mode in options.mode or sorted(modes):
+                    # errors should stop the benchmark, not be timed as 500 responses
+                    app = WSGIModuloApp(tree, raise_exceptions=True, **modes[mode])
+                    # short runs are noisy, so keep the best of several
+                    result = max((run(app, paths, options.requests) for i in xrange(options.repeat)), key=lambda r: r['rps'])
+                    result.update(tree=name, width=width, depth=depth, mode=mode)
+                    results.append(result)
+                    if not options.json:
+                        print '%-8s %5d %5s %-9s %10.1f req/s   p50 %7.3f ms   p95 %7.3f ms   p99 %7.3f ms   %6.1f gc objs/req' % (
+                            name, width, depth or '-', mode, result['rps'],
+                            result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000,
+                            result['gc_objects']
+                        )
+                        sys.stdout.flush()
+    if options.json:
+        print json.dumps(results, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+'''Checks for :class:`~modulo.actions.cache.ResponseCache`.
+
+The checks are run against :class:`~modulo.actions.cache.MemoryCache` and
+against Werkzeug's ``MemcachedCache``, using :class:`FakeMemcacheClient` in
+place of a real memcached server, so no server is needed. For each backend
+they check that a repeated request is answered from the cache without running
+the wrapped actions, that requests for another host or scheme aren't, that
+cached responses expire, that responses which set cookies or have other status
+codes aren't cached, and that headers set outside the cache are kept when a
+cached response is used. Run it directly; it prints
+``ok`` for each backend, or fails with an ``AssertionError``.'''
+
+import cPickle
+import sys
+from os.path import abspath, dirname
+
+basedir = dirname(dirname(dirname(abspath(__file__))))
+if basedir not in sys.path:
+    sys.path.append(basedir)
+
+from modulo import WSGIModuloApp, all_of
+from modulo.actions import Action
+from modulo.actions.cache import MemoryCache, ResponseCache
+from werkzeug import BaseResponse
+from werkzeug.contrib.cache import MemcachedCache
+from werkzeug.exceptions import NotFound
+from werkzeug.test import Client
+
+class FakeMemcacheClient(object):
+    '''Stands in for ``memcache.Client``, keeping the items in a dict.
+
+    Like memcached, it stores a pickled copy of each value and treats a timeout
+    as a number of seconds from now. The current time is :attr:`now`, which
+    only changes when the checks advance it.'''
+    def __init__(self):
+        self.items = {}
+        self.now = 0
+
+    def get(self, key):
+        try:
+            expires, data = self.items[key]
+        except KeyError:
+            return None
+        if expires and expires <= self.now:
+            del self.items[key]
+            return None
+        return cPickle.loads(data)
+
+    def set(self, key, value, timeout=0):
+        self.items[key] = (timeout and self.now + timeout, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        return True
+
+class FakeClock(object):
+    '''Replaces ``time.time`` in :mod:`modulo.actions.cache` for the
+    :class:`MemoryCache` checks, so that expiry can be checked without waiting.'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+calls = []
+
+class Page(Action):
+    '''Renders a page, noting that it was called.'''
+    def generate(self, rsp):
+        calls.append(self.req.path)
+        rsp.data = 'page %s' % self.req.path
+        rsp.headers['X-Page'] = self.req.path
+
+class SetCookie(Action):
+    def generate(self, rsp):
+        rsp.set_cookie('visitor', 'new')
+
+class Missing(Action):
+    def generate(self, rsp):
+        raise NotFound()
+
+class Outside(Action):
+    '''Sets headers which differ on every request, outside the cache.'''
+    count = [0]
+    def generate(self, rsp):
+        self.count[0] += 1
+        rsp.headers['Date'] = 'request %d' % self.count[0]
+        rsp.headers['X-Outside'] = str(self.count[0])
+
+def get(tree, path, base_url=None):
+    return Client(WSGIModuloApp(tree, raise_exceptions=True), BaseResponse).get(path, base_url=base_url)
+
+def check(backend, advance):
+    '''Runs the checks against ``backend``. ``advance(seconds)`` moves the
+    backend's clock forward.'''
+    del calls[:]
+    tree = ResponseCache(Page, backend=backend, timeout=60, key_prefix='page:')
+    first = get(tree, '/a')
+    second = get(tree, '/a')
+    assert calls == ['/a'], 'second request was not a hit: %r' % calls
+    assert first.data == second.data == 'page /a'
+    assert second.headers['X-Page'] == '/a'
+    get(tree, '/b')
+    assert calls == ['/a', '/b'], 'different path was not a miss: %r' % calls
+    get(tree, '/a', base_url='http://other.example/')
+    get(tree, '/a', base_url='https://localhost/')
+    assert calls == ['/a', '/b', '/a', '/a'], 'different host or scheme was not a miss: %r' % calls
+    del calls[:]
+
+    # expiry
+    advance(30)
+    get(tree, '/a')
+    assert calls == [], 'expired too early: %r' % calls
+    advance(31)
+    get(tree, '/a')
+    assert calls == ['/a'], 'did not expire: %r' % calls
+
+    # responses that set cookies aren't cached
+    del calls[:]
+    tree = ResponseCache(all_of(Page, SetCookie), backend=backend, key_prefix='cookie:')
+    get(tree, '/c')
+    get(tree, '/c')
+    assert calls == ['/c', '/c'], 'response with Set-Cookie was cached: %r' % calls
+
+    # only the listed status codes are cached
+    tree = ResponseCache(all_of(Page, Missing), backend=backend, key_prefix='missing:')
+    assert get(tree, '/d').status_code == 404
+    assert get(tree, '/d').status_code == 404
+    assert calls == ['/c', '/c', '/d', '/d'], '404 response was cached: %r' % calls
+
+    # headers set before the cache are per request; the cached ones are replayed
+    del calls[:]
+    tree = all_of(Outside, SetCookie, ResponseCache(Page, backend=backend, key_prefix='outside:'))
+    first = get(tree, '/e')
+    second = get(tree, '/e')
+    assert calls == ['/e'], 'second request was not a hit: %r' % calls
+    assert second.headers['X-Page'] == '/e'
+    assert second.headers['X-Outside'] != first.headers['X-Outside']
+    assert second.headers['Date'] != first.headers['Date']
+    assert 'visitor=new' in second.headers.get('Set-Cookie', ''), 'Set-Cookie from outside the cache was lost'
+
+def main():
+    client = FakeMemcacheClient()
+    def advance(seconds):
+        client.now += seconds
+    check(MemcachedCache(client), advance)
+    print 'MemcachedCache ok'
+
+    import modulo.actions.cache
+    clock = FakeClock()
+    real_time = modulo.actions.cache.time
+    modulo.actions.cache.time = clock
+    try:
+        def advance(seconds):
+            clock.now += seconds
+        check(MemoryCache(100), advance)
+
+        # add() only replaces an item once it has expired
+        cache = MemoryCache(100)
+        assert cache.add('k', 1, 10)
+        assert not cache.add('k', 2, 10)
+        assert cache.get('k') == 1
+        advance(10)
+        assert cache.add('k', 3, 10)
+        assert cache.get('k') == 3
+    finally:
+        modulo.actions.cache.time = real_time
+    print 'MemoryCache ok'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+'''Checks for :class:`~modulo.actions.dispatch.RoutingCache`.
+
+They check that a request routed through the cache ends up at the same actions
+as it would without the cache, including when a subclass of a cacheable filter
+overrides ``handles()`` to look at something that isn't in ``handles_keys``;
+that such a subclass doesn't have its ``handles()`` memoized; and that a
+remembered route which doesn't work out is counted as a miss. Run it directly;
+it prints ``ok``, or fails with an ``AssertionError``.'''
+
+import sys
+from os.path import abspath, dirname
+
+basedir = dirname(dirname(dirname(abspath(__file__))))
+if basedir not in sys.path:
+    sys.path.append(basedir)
+
+from modulo import WSGIModuloApp, all_of, any_of
+from modulo.actions import Action
+from modulo.actions.dispatch import RoutingCache, routing_cacheable
+from modulo.actions.filters import URIFilter
+from werkzeug import BaseResponse
+from werkzeug.test import Client
+
+class OkFilter(URIFilter):
+    '''Only accepts requests for its path which have ``ok=1`` in the query string.'''
+    regex = '/x'
+    calls = [0]
+
+    @classmethod
+    def handles(cls, req, params):
+        cls.calls[0] += 1
+        return URIFilter.handles.im_func(cls, req, params) and req.args.get('ok') == '1'
+
+class A(Action):
+    def generate(self, rsp):
+        rsp.data = 'A'
+
+class B(Action):
+    def generate(self, rsp):
+        rsp.data = 'B'
+
+def get(app, path):
+    return Client(app, BaseResponse).get(path).data
+
+def main():
+    assert OkFilter.handles_keys is None and not OkFilter.handles_cacheable
+    assert not routing_cacheable(OkFilter)
+
+    tree = any_of(all_of(OkFilter, A), B)
+    paths = ['/x?ok=0', '/x?ok=1', '/x?ok=0', '/x?ok=1']
+    plain = [get(WSGIModuloApp(tree, raise_exceptions=True), path) for path in paths]
+    assert plain == ['B', 'A', 'B', 'A'], plain
+    cached = WSGIModuloApp(tree, raise_exceptions=True, routing_cache_size=100)
+    results = [get(cached, path) for path in paths]
+    assert results == plain, 'routing cache chose %r instead of %r' % (results, plain)
+
+    # handles() is asked again in each branch, because it isn't memoized
+    OkFilter.calls[0] = 0
+    get(WSGIModuloApp(all_of(OkFilter, OkFilter, A), raise_exceptions=True), '/x?ok=1')
+    assert OkFilter.calls[0] == 2, 'handles() of the subclass was memoized'
+
+    # a remembered route that doesn't work out is a miss, not a hit
+    state = {'ok': True}
+    class Flaky(Action):
+        handles_keys = ('PATH_INFO',)
+        handles_cacheable = True
+        @classmethod
+        def handles(cls, req, params):
+            return state['ok']
+    routing = RoutingCache(any_of(all_of(URIFilter('/y'), Flaky, A), B), 100)
+    app = WSGIModuloApp(routing, raise_exceptions=True)
+    assert get(app, '/y') == 'A'
+    assert get(app, '/y') == 'A'
+    assert (routing.hits, routing.misses) == (1, 1), (routing.hits, routing.misses)
+    state['ok'] = False
+    assert get(app, '/y') == 'B'
+    assert (routing.hits, routing.misses) == (1, 2), (routing.hits, routing.misses)
+    print 'ok'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+'''Benchmarks for the templating backends in :mod:`modulo.templating`.
+
+Every backend renders the same page (a title, a greeting, a list of items, and
+a value from the WSGI environment) from the same parameter set, inside the same
+small action tree, so the numbers can be compared directly. For each backend
+this reports
+
+- the time taken by the first request, which includes loading, parsing and
+  compiling the template (the "cold" time)
+- requests per second and latency percentiles once the backend has warmed up
+- the growth in the maximum resident set size of the process while the
+  backend was being benchmarked, and the number of objects each request leaves
+  behind for the garbage collector
+
+Backends whose templating library isn't installed are skipped. Each backend is
+run in a separate process, so that the cold times and memory figures aren't
+affected by the backends that ran before it. Run it with ``--help`` to see the
+options.
+
+:class:`PythonTemplate` can't loop and doesn't see the WSGI environment, so its
+version of the page gets the list of items already formatted, from the
+``item_list`` parameter, and has the path written in.'''
+
+import json
+import logging
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+
+basedir = dirname(dirname(dirname(abspath(__file__))))
+if basedir not in sys.path:
+    sys.path.append(basedir)
+
+from modulo import WSGIModuloApp, all_of, timer
+from modulo.actions import Action
+from modulo.test.benchmark import run
+from werkzeug.test import create_environ
+
+class PageData(Action):
+    '''Provides the parameters that every version of the page is rendered with.'''
+    items = [{'name': 'item %d' % i, 'price': '%d.99' % i} for i in range(20)]
+    item_list = ''.join('<li>%(name)s: %(price)s</li>' % item for item in items)
+
+    def generate(self, rsp):
+        return {'title': 'Benchmark', 'user': 'world', 'items': self.items, 'item_list': self.item_list}
+
+sources = {
+    'python': '''<html><head><title>$title</title></head><body><h1>Hello $user</h1>
+<ul>$item_list</ul><p>/page</p></body></html>''',
+    'mini': '''<html><head><title>${title}</title></head><body><h1>Hello ${user}</h1>
+<ul><% for item in items %><li>${item['name']}: ${item['price']}</li><% endfor %></ul><p>${PATH_INFO}</p></body></html>''',
+    'jinja2': '''<html><head><title>{{ title }}</title></head><body><h1>Hello {{ user }}</h1>
+<ul>{% for item in items %}<li>{{ item.name }}: {{ item.price }}</li>{% endfor %}</ul><p>{{ PATH_INFO }}</p></body></html>''',
+    'mako': '''<html><head><title>${title}</title></head><body><h1>Hello ${user}</h1>
+<ul>
+% for item in items:
+<li>${item['name']}: ${item['price']}</li>
+% endfor
+</ul><p>${PATH_INFO}</p></body></html>''',
+    'genshi': '''<html xmlns:py="http://genshi.edgewall.org/"><head><title>${title}</title></head><body><h1>Hello ${user}</h1>
+<ul><li py:for="item in items">${item.name}: ${item.price}</li></ul><p>${PATH_INFO}</p></body></html>''',
+    'cheetah': '''<html><head><title>$title</title></head><body><h1>Hello $user</h1>
+<ul>#for $item in $items#<li>$item.name: $item.price</li>#end for#</ul><p>$PATH_INFO</p></body></html>''',
+    'clearsilver': '''<html><head><title><?cs var:title ?></title></head><body><h1>Hello <?cs var:user ?></h1>
+<ul><?cs each:item = items ?><li><?cs var:item.name ?>: <?cs var:item.price ?></li><?cs /each ?></ul><p><?cs var:CGI.PathInfo ?></p></body></html>''',
+}
+
+def write(directory, name, source):
+    filename = join(directory, name)
+    f = open(filename, 'w')
+    try:
+        f.write(source)
+    finally:
+        f.close()
+    return filename
+
+# Each of these returns the action that renders the page, given a directory to
+# put template files in. Imports are done inside the functions so that a missing
+# library only rules out the backends that need it.
+
+def python_template(directory):
+    from modulo.templating import PythonTemplate
+    return PythonTemplate(sources['python'])
+
+def mini_template(directory):
+    from modulo.templating.minitmpl import MiniTemplate
+    return MiniTemplate(filename=write(directory, 'page.tmpl', sources['mini']))
+
+def mini_string_template(directory):
+    from modulo.templating.minitmpl import MiniStringTemplate
+    return MiniStringTemplate(sources['mini'])
+
+def jinja_template(directory):
+    from jinja2 import DictLoader, Environment
+    from modulo.templating.jinja2 import JinjaEnvironment, JinjaTemplate
+    env = Environment(loader=DictLoader({'page.html': sources['jinja2']}))
+    # JinjaTemplate takes the environment from the parameters
+    return JinjaEnvironment(env=env) & JinjaTemplate(template_name='page.html')
+
+def jinja_filesystem_template(directory):
+    from modulo.templating.jinja2 import JinjaFilesystemTemplate
+    write(directory, 'page.jinja', sources['jinja2'])
+    return JinjaFilesystemTemplate(directory, filename='page.jinja')
+
+def mako_string_template(directory):
+    from modulo.templating.mako import MakoStringTemplate
+    return MakoStringTemplate(template=sources['mako'])
+
+def mako_filesystem_template(directory):
+    from modulo.templating.mako import MakoFilesystemTemplate
+    return MakoFilesystemTemplate(filename=write(directory, 'page.mako', sources['mako']))
+
+def genshi_filesystem_template(directory):
+    from modulo.templating.genshi import GenshiFilesystemTemplate, GenshiStreamRenderer
+    write(directory, 'page.genshi', sources['genshi'])
+    return GenshiFilesystemTemplate(filename='page.genshi', search_path=directory) & GenshiStreamRenderer
+
+def cheetah_string_template(directory):
+    from modulo.templating.cheetah import CheetahStringTemplate
+    return CheetahStringTemplate(template=sources['cheetah'])
+
+def cheetah_filesystem_template(directory):
+    from modulo.templating.cheetah import CheetahFilesystemTemplate
+    return CheetahFilesystemTemplate(filename=write(directory, 'page.tmpl', sources['cheetah']))
+
+def cheetah_compiled_template(directory):
+    from Cheetah.Template import Template
+    from modulo.templating.cheetah import CheetahCompiledTemplate
+    return CheetahCompiledTemplate(Template.compile(source=sources['cheetah']))
+
+def clearsilver_rendering(directory):
+    from modulo.templating.clearsilver import ClearsilverRendering, ClearsilverTemplate
+    return ClearsilverTemplate(filename=write(directory, 'page.cst', sources['clearsilver'])) & ClearsilverRendering
+
+backends = {
+    'PythonTemplate': python_template,
+    'MiniTemplate': mini_template,
+    'MiniStringTemplate': mini_string_template,
+    'JinjaTemplate': jinja_template,
+    'JinjaFilesystemTemplate': jinja_filesystem_template,
+    'MakoStringTemplate': mako_string_template,
+    'MakoFilesystemTemplate': mako_filesystem_template,
+    'GenshiFilesystemTemplate': genshi_filesystem_template,
+    'CheetahStringTemplate': cheetah_string_template,
+    'CheetahFilesystemTemplate': cheetah_filesystem_template,
+    'CheetahCompiledTemplate': cheetah_compiled_template,
+    'ClearsilverRendering': clearsilver_rendering,
+}
+
+def maxrss():
+    '''Returns the maximum resident set size of this process so far, in kilobytes.'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes on Mac OS X
+        rss //= 1024
+    return rss
+
+def benchmark(name, requests):
+    '''Benchmarks the backend ``name`` in this process and returns a dict of
+    results, or ``None`` if the library it needs isn't installed.'''
+    directory = tempfile.mkdtemp(prefix='modulo-benchmark-')
+    try:
+        rss0 = maxrss()
+        try:
+            action = backends[name](directory)
+        except ImportError, e:
+            logging.getLogger('modulo.test').warning('skipping %s: %s', name, e)
+            return None
+        app = WSGIModuloApp(all_of(PageData, action), raise_exceptions=True)
+        def start_response(status, headers, exc_info=None):
+            if not status.startswith('200'):
+                raise RuntimeError('%s returned %s' % (name, status))
+        t0 = timer()
+        for chunk in app(create_environ('/page'), start_response):
+            pass
+        cold = timer() - t0
+        result = run(app, ['/page'], requests)
+        result.update(backend=name, cold=cold, rss_growth=maxrss() - rss0)
+        return result
+    finally:
+        shutil.rmtree(directory, True)
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [backend ...]', description='Benchmark the Modulo templating backends: ' + ', '.join(sorted(backends)))
+    parser.add_option('-n', '--requests', type='int', default=1000, help='number of warm requests to time for each backend (default %default)')
+    parser.add_option('--json', action='store_true', help='print the results as JSON instead of a table')
+    parser.add_option('--child', action='store_true', help='benchmark one backend in this process and print the result as JSON (used internally)')
+    options, args = parser.parse_args(argv)
+    for name in args:
+        if name not in backends:
+            parser.error('unknown backend: ' + name)
+
+    logging.getLogger('modulo').setLevel(logging.WARNING)
+
+    if options.child:
+        print json.dumps(benchmark(args[0], options.requests))
+        return
+
+    results = []
+    for name in args or sorted(backends):
+        child = subprocess.Popen([sys.executable, abspath(__file__), '--child', '-n', str(options.requests), name], stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        if child.returncode:
+            logging.getLogger('modulo.test').error('%s failed', name)
+            continue
+        result = json.loads(output)
+        if result is None:
+            continue
+        results.append(result)
+        if not options.json:
+            print '%-26s cold %8.2f ms   %9.1f req/s   p50 %7.3f ms   p95 %7.3f ms   p99 %7.3f ms   rss +%6d KB   %6.1f gc objs/req' % (
+                name, result['cold'] * 1000, result['rps'],
+                result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000,
+                result['rss_growth'], result['gc_objects']
+            )
+            sys.stdout.flush()
+    if options.json:
+        print json.dumps(results, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,9 @@
 
 import datetime
 import hashlib
-import inspect
+import sys
+import threading
+from collections import OrderedDict
 
 _rfc1123_fmt = '%a, %d %b %Y %H:%M:%S GMT'
 _rfc850_fmt = '%A, %d-%b-%y %H:%M:%S GMT'
@@ -53,12 +55,45 @@ def uri_path(environ):
 dummy = object()
 
 class wrap_dict(dict):
-    def __init__(self, parent):
+    '''A dictionary layered on top of another mapping, its parent.
+
+    Looking up a key that hasn't been set in the ``wrap_dict`` itself falls through
+    to the parent, and setting or deleting a key only affects the ``wrap_dict``,
+    never the parent. This makes it cheap to create a modified version of a
+    dictionary without copying it. The parent should be treated as read-only,
+    though, because changes to it show through unless they're overridden.
+
+    Any positional or keyword arguments after ``parent`` are used to initialize
+    the ``wrap_dict`` the same way they would be for ``dict.update()``.
+
+    Each layer makes lookups a little slower, so when a ``wrap_dict`` is created
+    on top of a stack of more than ``max_depth`` others, the stack is flattened
+    into a plain dictionary first.
+
+    Note that the methods of ``dict`` implemented in C don't know about the parent;
+    this is why ``copy()`` returns a plain (flattened) ``dict``, and you should use
+    that (not ``dict(d)``) if you need something to pass as ``**kwargs``.'''
+    max_depth = 8
+
+    def __init__(self, parent=None, *args, **kwargs):
+        dict.__init__(self)
+        if parent is None:
+            parent = {}
+        if isinstance(parent, wrap_dict):
+            if parent.depth >= self.max_depth:
+                parent = parent.copy()
+                self.depth = 1
+            else:
+                self.depth = parent.depth + 1
+        else:
+            self.depth = 1
         self.__parent = parent
+        if args or kwargs:
+            self.update(*args, **kwargs)
 
     def __getitem__(self, key):
         try:
-            val = super(wrap_dict, self).__getitem__(key)
+            val = dict.__getitem__(self, key)
         except KeyError:
             return self.__parent[key]
         else:
@@ -66,14 +101,194 @@ class wrap_dict(dict):
                 raise KeyError(key)
             return val
 
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key) is not dummy
+        return key in self.__parent
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.__parent:
+            dict.__setitem__(self, key, dummy)
+        else:
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        try:
+            val = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return val
+
+    def popitem(self):
+        for key in self:
+            return key, self.pop(key)
+        raise KeyError('popitem(): dictionary is empty')
+
+    def setdefault(self, key, default=None):
         try:
-            super(wrap_dict, self).__delitem__(key)
+            return self[key]
         except KeyError:
-            self[key] = dummy
+            self[key] = default
+            return default
+
+    def update(self, *args, **kwargs):
+        for other in args:
+            if hasattr(other, 'keys'):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, val in other:
+                    self[key] = val
+        for key, val in kwargs.iteritems():
+            self[key] = val
+
+    def clear(self):
+        dict.clear(self)
+        for key in self.__parent:
+            dict.__setitem__(self, key, dummy)
+
+    def iterkeys(self):
+        for key, val in dict.iteritems(self):
+            if val is not dummy:
+                yield key
+        for key in self.__parent:
+            if not dict.__contains__(self, key):
+                yield key
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for key in self.iterkeys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key, self[key]
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __len__(self):
+        return sum(1 for key in self.iterkeys())
+
+    def __nonzero__(self):
+        for key in self.iterkeys():
+            return True
+        return False
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, wrap_dict):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
+
+class namespace_dict(dict):
+    '''The parameter set which is passed along as actions handle a request.
+
+    This maps namespace names to dictionaries of parameters. Like a
+    ``defaultdict(dict)``, accessing a namespace that doesn't exist creates it,
+    empty. :meth:`layer` creates a new parameter set with some values overridden
+    in one namespace, using a :class:`wrap_dict` so that nothing has to be copied
+    except the (short) mapping of namespaces itself.'''
+    def __missing__(self, ns):
+        d = self[ns] = {}
+        return d
+
+    def layer(self, ns, values):
+        '''Returns a new ``namespace_dict`` in which namespace ``ns`` has the
+        items of ``values`` added on top of the ones in this one.'''
+        params = namespace_dict(self)
+        params[ns] = wrap_dict(self[ns], values)
+        return params
+
+    def copy(self):
+        return namespace_dict(self)
+
+class LRUCache(object):
+    '''A thread-safe dictionary-like cache which holds at most ``capacity`` items.
+
+    When the cache is full, adding a new item evicts the one which was least
+    recently used. The number of successful and unsuccessful lookups made with
+    :meth:`get` are counted in :attr:`hits` and :attr:`misses`.'''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__data[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self.__lock:
+            self.__data.pop(key, None)
+            self.__data[key] = value
+            while len(self.__data) > self.capacity:
+                self.__data.popitem(last=False)
+
+    def add(self, key, value, replace=None):
+        '''Stores ``value`` under ``key`` if there's no item with that key yet, and
+        returns true if it did. If ``replace`` is given, an existing item is
+        replaced too if ``replace(item)`` returns true. The check and the insert
+        are done together, so no other thread can store an item in between.'''
+        with self.__lock:
+            if key in self.__data and (replace is None or not replace(self.__data[key])):
+                return False
+            self.__data.pop(key, None)
+            self.__data[key] = value
+            while len(self.__data) > self.capacity:
+                self.__data.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __contains__(self, key):
+        return key in self.__data
 
-    def __del__(self):
-        del self.__parent
+    def __len__(self):
+        return len(self.__data)
 
 # TODO: combine this with modulo.templating.clearsilver._hdfproxy
 class attribute_dict(dict):
@@ -116,17 +331,24 @@ def check_params(params):
         return [], {}
 
 def compact(*names):
-    caller = inspect.stack()[1][0] # caller of compact()
+    '''Returns a dict mapping each of ``names`` to the value of the variable of
+    that name in the calling function, looking in its locals and then its globals.
+    Names which aren't defined are left out.'''
+    # sys._getframe() just hands back the frame; inspect.stack() would also
+    # build a record, including source context, for every frame on the stack
+    caller = sys._getframe(1) # caller of compact()
+    f_locals = caller.f_locals
+    f_globals = caller.f_globals
     vars = {}
     for n in names:
-        if n in caller.f_locals:
-            vars[n] = caller.f_locals[n]
-        elif n in caller.f_globals:
-            vars[n] = caller.f_globals[n]
+        if n in f_locals:
+            vars[n] = f_locals[n]
+        elif n in f_globals:
+            vars[n] = f_globals[n]
     return vars
 
 def extract(vars):
-    caller = inspect.stack()[1][0] # caller of extract()
+    caller = sys._getframe(1) # caller of extract()
     for n, v in vars.iteritems():
         caller.f_locals[n] = v   # NEVER DO THIS ;-)
 